@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Compares steady state collection CPU time when rebuilding the registry on every collection,
+when reusing the layout of the previous collection and when also exporting derived metrics of
+all metrics.
+
+A collection converts already fetched responses with Collector.to_registry and renders the result,
+values change between collections while the metric set does not.
+
+Usage: python -m benchmarks.collect [--metrics N] [--collections N]
+"""
+
+import argparse
+import json
+import time
+
+from stellar_core_prometheus_exporter import exporter, lib
+
+from .fake_core import CURSORS, INFO, make_metrics
+
+
+def responses(metrics, collection):
+    # Moves every value like a live core does between collections
+    for metric in metrics['metrics'].values():
+        if 'count' in metric:
+            metric['count'] += collection
+        for bucket in metric.get('buckets', ()):
+            bucket['count'] += collection
+    return ((200, json.dumps(metrics).encode('utf-8')),
+            (200, json.dumps(INFO).encode('utf-8')),
+            (200, json.dumps(CURSORS).encode('utf-8')))
+
+
+def run(label, incremental, metrics, collections, derived_filter=None):
+    # Every collection is longer than the derived metrics window and so compared with the previous one
+    collector = exporter.Collector('http://127.0.0.1:11626', derived_filter=derived_filter, derived_window=0.001)
+    samples = 0
+    elapsed = 0
+    for i in range(collections + 1):
+        args = responses(metrics, i)
+        if not incremental:
+            collector.layout = None
+        started = time.process_time()
+        registry = collector.to_registry(*args)
+        output = registry.render()
+        if i:
+            # The first collection builds the layout
+            elapsed += time.process_time() - started
+        samples = registry.sample_count()
+    print('{:<12} {:>8} samples {:>8.2f} ms CPU per collection {:>8} bytes'.format(
+        label, samples, elapsed * 1000 / collections, len(output)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='steady state collection benchmark')
+    parser.add_argument('--metrics', type=int, default=1000, help='metrics in the synthetic document')
+    parser.add_argument('--collections', type=int, default=50, help='measured collections per mode')
+    args = parser.parse_args()
+
+    run('rebuild', False, make_metrics(args.metrics), args.collections)
+    run('incremental', True, make_metrics(args.metrics), args.collections)
+    run('derived', True, make_metrics(args.metrics), args.collections, lib.MetricFilter(include=['.*']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Compares converting bucket metrics with lib.bucket_counts against the previous per value conversion.
+
+The previous conversion called duration_to_seconds for every boundary and sum, first with eval and
+then with the unit table, bucket_counts looks the unit up once per metric.
+
+Usage: python -m benchmarks.duration [number of bucket metrics]
+"""
+
+import sys
+import timeit
+
+from stellar_core_prometheus_exporter import lib
+
+
+def legacy_duration_to_seconds(duration, duration_unit):
+    # lib.duration_to_seconds before the lookup table
+    time_units_to_seconds = {
+        'd':  'duration * 86400.0',
+        'h':  'duration * 3600.0',
+        'm':  'duration * 60.0',
+        's':  'duration / 1.0',
+        'ms': 'duration / 1000.0',
+        'us': 'duration / 1000000.0',
+        'ns': 'duration / 1000000000.0',
+    }
+    return eval(time_units_to_seconds[duration_unit])
+
+
+def per_value_bucket_counts(metric, to_seconds):
+    # Bucket conversion of the exporter before bucket_counts, to_seconds is called per value
+    unit = metric['boundary_unit']
+    measurements = []
+    for bucket in metric['buckets']:
+        measurements.append({'boundary': to_seconds(bucket['boundary'], unit), 'count': bucket['count'],
+                             'sum': bucket['sum']})
+    bounds = []
+    counts = []
+    count_value = 0
+    sum_value = 0
+    for m in sorted(measurements, key=lambda i: i['boundary']):
+        count_value += m['count']
+        sum_value += to_seconds(m['sum'], unit)
+        if float(m['boundary']) > 30 * 86400:
+            continue
+        bounds.append(m['boundary'])
+        counts.append(count_value)
+    bounds.append('+Inf')
+    counts.append(count_value)
+    return bounds, counts, count_value, sum_value
+
+
+def legacy(payload):
+    for metric in payload:
+        per_value_bucket_counts(metric, legacy_duration_to_seconds)
+
+
+def per_value(payload):
+    for metric in payload:
+        per_value_bucket_counts(metric, lib.duration_to_seconds)
+
+
+def bucket_counts(payload):
+    for metric in payload:
+        lib.bucket_counts(metric)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    boundaries = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 1e12]
+    payload = [{'type': 'buckets', 'boundary_unit': 'ms',
+                'buckets': [{'boundary': b, 'count': 3, 'sum': b * 1.5} for b in boundaries]}
+               for _ in range(count)]
+    # All variants must convert to the same result
+    assert per_value_bucket_counts(payload[0], legacy_duration_to_seconds) == lib.bucket_counts(payload[0])
+    print('{} bucket metrics, {} conversions per scrape'.format(count, count * len(boundaries) * 2))
+    for label, func in (('eval', legacy), ('table', per_value), ('bucket_counts', bucket_counts)):
+        runs = 20
+        elapsed = timeit.timeit(lambda: func(payload), number=runs) / runs
+        print('{:<13} {:>8.2f} ms per scrape'.format(label, elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Stand-in stellar-core admin HTTP server serving /metrics, /info and /getcursor.
+
+Documents are synthetic or replayed from fixtures recorded from a live node, e.g.
+`curl -o DIR/metrics.json http://127.0.0.1:11626/metrics`, likewise info.json and getcursor.json.
+Missing fixtures are replaced by synthetic documents.
+
+Usage: python -m benchmarks.fake_core [--port PORT] [--metrics COUNT] [--cursors COUNT] [--latency SECONDS]
+                                      [--fixtures DIR] [--old-quorum] [--no-getcursor] [--metrics-status CODE]
+"""
+
+import argparse
+import copy
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+BOUNDARIES = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 1e12]
+
+
+def make_metrics(count):
+    # Returns a /metrics document with count metrics, cycling through all libmedida types
+    metrics = {}
+    for i in range(count):
+        metric_type = ['timer', 'histogram', 'counter', 'meter', 'buckets'][i % 5]
+        name = 'overlay.message-{}.{}'.format(i, metric_type)
+        if metric_type == 'timer':
+            metrics[name] = {'type': 'timer', 'count': i, 'sum': i * 1.5, 'mean': 1.5, '75%': 1.2,
+                             '99%': 3.4, '100%': 5.6, 'duration_unit': 'ms', 'rate_unit': 's'}
+        elif metric_type == 'histogram':
+            metrics[name] = {'type': 'histogram', 'count': i, 'sum': i * 2, '75%': 1,
+                             '99%': 3, '100%': 5}
+        elif metric_type == 'buckets':
+            metrics[name] = {'type': 'buckets', 'boundary_unit': 'ms',
+                             'buckets': [{'boundary': b, 'count': i, 'sum': b / 2.0} for b in BOUNDARIES]}
+        else:
+            metrics[name] = {'type': metric_type, 'count': i}
+    return {'metrics': metrics}
+
+
+INFO = {
+    'info': {
+        'build': 'stellar-core 19.5.0 (6dd8bd5c8ae5a9f3bc4f4d0a9e7f5f79d4c6a4f8)',
+        'network': 'Test SDF Network ; September 2015',
+        'ledger': {'age': 3, 'baseFee': 100, 'baseReserve': 5000000, 'closeTime': 1672531200,
+                   'maxTxSetSize': 1000, 'num': 1234567, 'version': 19},
+        'peers': {'authenticated_count': 8, 'pending_count': 0},
+        'protocol_version': 19,
+        'quorum': {
+            'qset': {'agree': 3, 'delayed': 0, 'disagree': 0, 'fail_at': 1, 'missing': 0,
+                     'phase': 'EXTERNALIZE'},
+            'transitive': {'intersection': True, 'last_check_ledger': 1234500, 'node_count': 7,
+                           'critical': [['GABC', 'GDEF']]},
+        },
+        'startedOn': '2023-01-01T00:00:00Z',
+        'state': 'Synced!',
+    }
+}
+
+CURSORS = {'cursors': [{'id': 'HORIZON', 'cursor': 1234560}]}
+
+# Body of the 404 response of core versions and modes without the getcursor command
+UNKNOWN_COMMAND = b'Supported HTTP commands: bans, connect, info, metrics, peers, quorum, tx'
+
+
+def make_info(old_quorum=False):
+    # Returns an /info document, core before 11.2.0 keyed quorum data by ledger and had no transitive data
+    info = copy.deepcopy(INFO)
+    if old_quorum:
+        info['info']['build'] = 'v11.1.0'
+        info['info']['quorum'] = {'1234567': info['info']['quorum']['qset']}
+    return info
+
+
+def make_cursors(count):
+    # Returns a /getcursor document with count cursors
+    return {'cursors': [{'id': 'HORIZON{}'.format(i) if i else 'HORIZON', 'cursor': 1234560 - i}
+                        for i in range(count)]}
+
+
+class FakeCoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if path == '/metrics' and self.server.metrics_status != 200:
+            code, content_type, body = self.server.metrics_status, 'text/plain', b'Internal error'
+        elif path in self.server.documents:
+            code, content_type, body = 200, 'application/json', self.server.documents[path]
+        else:
+            code, content_type, body = 404, 'text/plain', UNKNOWN_COMMAND
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeCore(ThreadingMixIn, HTTPServer):
+    """Fake core listening on port, 0 picks a free port.
+
+    Serves a synthetic /metrics with the given number of metrics and /getcursor with the given
+    number of cursors unless fixtures, a directory of recorded metrics.json, info.json and
+    getcursor.json documents, has them. old_quorum serves the /info quorum format of core
+    before 11.2.0, getcursor=False responds to /getcursor like core without that command and
+    metrics_status other than 200 responds to /metrics with that status, like a failing core.
+    """
+    daemon_threads = True
+
+    def __init__(self, port, metrics=500, latency=0, fixtures=None, old_quorum=False, getcursor=True, cursors=1,
+                 metrics_status=200):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeCoreHandler)
+        self.latency = latency
+        self.metrics_status = metrics_status
+        self.documents = {
+            '/metrics': json.dumps(make_metrics(metrics)).encode('utf-8'),
+            '/info': json.dumps(make_info(old_quorum)).encode('utf-8'),
+            '/getcursor': json.dumps(make_cursors(cursors)).encode('utf-8'),
+        }
+        for path in list(self.documents):
+            fixture = fixtures and os.path.join(fixtures, path[1:] + '.json')
+            if fixture and os.path.exists(fixture):
+                with open(fixture, 'rb') as f:
+                    self.documents[path] = f.read()
+        if not getcursor:
+            del self.documents['/getcursor']
+
+    @property
+    def address(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake stellar-core admin HTTP server')
+    parser.add_argument('--port', type=int, default=11626)
+    parser.add_argument('--metrics', type=int, default=500, help='number of metrics served on /metrics')
+    parser.add_argument('--cursors', type=int, default=1, help='number of cursors served on /getcursor')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before every response')
+    parser.add_argument('--fixtures', type=str, help='directory of recorded metrics.json, info.json and getcursor.json')
+    parser.add_argument('--old-quorum', action='store_true', help='serve the quorum format of core before 11.2.0')
+    parser.add_argument('--no-getcursor', action='store_true', help='respond to /getcursor with 404')
+    parser.add_argument('--metrics-status', type=int, default=200, help='status code of /metrics responses')
+    args = parser.parse_args()
+    FakeCore(args.port, metrics=args.metrics, latency=args.latency, fixtures=args.fixtures,
+             old_quorum=args.old_quorum, getcursor=not args.no_getcursor, cursors=args.cursors,
+             metrics_status=args.metrics_status).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
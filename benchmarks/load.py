@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Load tests the exporter in threading and asyncio mode against a local fake stellar-core.
+
+Reports scrape throughput and latency percentiles, CPU time per scrape and peak thread count and
+RSS of the exporter process. Linux only, process stats are read from /proc.
+
+Usage: python -m benchmarks.load [--scrapers N] [--scrapes N] [--metrics N] [--latency SECONDS]
+"""
+
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from .fake_core import FakeCore
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_exporter(core_address, extra_args):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'stellar_core_prometheus_exporter.exporter',
+                                '--stellar-core-address', core_address, '--port', str(port)] + extra_args)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, 'http://127.0.0.1:{}/metrics'.format(port)
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('exporter did not start')
+
+
+def process_stats(pid):
+    # Returns thread count and RSS in KiB
+    stats = {}
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            stats[name] = value.split()[0] if value.split() else ''
+    return int(stats['Threads']), int(stats['VmRSS'])
+
+
+def process_cpu(pid):
+    # Returns user and system CPU seconds used by the process
+    with open('/proc/{}/stat'.format(pid)) as f:
+        # fields after the parenthesized command name, utime and stime are fields 14 and 15
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def process_tree(pid):
+    # Returns pid followed by the pids of its child processes, like --workers processes
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # the parent pid follows the state after the parenthesized command name
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def stop(pids):
+    # Kills the child processes before their parent
+    for pid in reversed(pids):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def fetch(url, headers=None):
+    # Scrapes url, returns the status code and the media type of the response
+    try:
+        with urlopen(Request(url, headers=headers or {}), timeout=30) as response:
+            response.read()
+            return response.status, response.headers.get_content_type()
+    except HTTPError as e:
+        e.read()
+        return e.code, e.headers.get_content_type()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(core_address, extra_args, scrapers, scrapes, headers=None, status=200, media_type=None):
+    """Scrapes an exporter started with extra_args from scrapers threads, scrapes times each.
+
+    Scrapes fail unless they are answered with status, e.g. 504 for a failing core, and media_type
+    if given. Process stats include child processes of the exporter. Returns a dict of results,
+    without latencies if all scrapes failed.
+    """
+    process, url = start_exporter(core_address, extra_args)
+    # Measure from the first scrape answered as expected, pollers need to collect a snapshot first and
+    # --workers publish formats other than text once they were requested
+    deadline = time.time() + 10
+    while True:
+        try:
+            code, content_type = fetch(url, headers)
+            if code == status and media_type in (None, content_type):
+                break
+        except Exception:
+            pass
+        if time.time() > deadline:
+            break
+        time.sleep(0.1)
+    pids = process_tree(process.pid)
+    latencies = []
+    errors = []
+    peak = [0, 0]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            stats = [process_stats(pid) for pid in pids]
+            peak[0] = max(peak[0], sum(threads for threads, _ in stats))
+            peak[1] = max(peak[1], sum(rss for _, rss in stats))
+            time.sleep(0.01)
+
+    def scrape():
+        for _ in range(scrapes):
+            started = time.time()
+            try:
+                code, content_type = fetch(url, headers)
+            except Exception as e:
+                errors.append(e)
+                continue
+            if code != status:
+                errors.append('status {}, expected {}'.format(code, status))
+                continue
+            if media_type not in (None, content_type):
+                errors.append('{} response, expected {}'.format(content_type, media_type))
+                continue
+            latencies.append(time.time() - started)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    workers = [threading.Thread(target=scrape) for _ in range(scrapers)]
+    cpu = sum(process_cpu(pid) for pid in pids)
+    started = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - started
+    cpu = sum(process_cpu(pid) for pid in pids) - cpu
+    done.set()
+    sampler.join()
+    stop(pids)
+    process.wait()
+    result = {'errors': len(errors), 'first_error': errors and str(errors[0]), 'threads': peak[0],
+              'rss_mib': peak[1] / 1024.0}
+    if latencies:
+        result.update({'scrapes_per_second': len(latencies) / elapsed,
+                       'p50_ms': percentile(latencies, 50) * 1000,
+                       'p99_ms': percentile(latencies, 99) * 1000,
+                       'cpu_ms_per_scrape': cpu * 1000 / len(latencies)})
+    return result
+
+
+def report(label, result):
+    if 'p50_ms' not in result:
+        print('{:<20} all scrapes failed: {}'.format(label, result['first_error']))
+        return
+    print('{:<20} {scrapes_per_second:>7.1f} scrapes/s  p50 {p50_ms:>7.1f} ms  p99 {p99_ms:>7.1f} ms  '
+          'cpu {cpu_ms_per_scrape:>6.1f} ms/scrape  errors {errors:>3}  threads {threads:>4}  '
+          'rss {rss_mib:>6.1f} MiB'.format(label, **result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='exporter load test')
+    parser.add_argument('--scrapers', type=int, default=20, help='number of concurrent scrapers')
+    parser.add_argument('--scrapes', type=int, default=10, help='scrapes per scraper')
+    parser.add_argument('--metrics', type=int, default=1000, help='number of metrics served by the fake core')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake core response latency in seconds')
+    args = parser.parse_args()
+
+    core = FakeCore(0, metrics=args.metrics, latency=args.latency).start()
+    print('{} scrapers x {} scrapes, {} core metrics, {} ms core latency'.format(
+        args.scrapers, args.scrapes, args.metrics, args.latency * 1000))
+    report('threading', run(core.address, [], args.scrapers, args.scrapes))
+    report('asyncio', run(core.address, ['--asyncio'], args.scrapers, args.scrapes))
+    core.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Compares memory held by lib.Registry with the previous tuple per sample storage.
+
+Builds a synthetic registry of timers with quantiles, bucket histograms and cursors and reports
+memory retained by the registry and peak memory while rendering it beyond the rendered output,
+measured with tracemalloc.
+
+Usage: python -m benchmarks.memory [number of samples]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from stellar_core_prometheus_exporter import lib
+
+
+LABEL_NAMES = ['ver_major', 'ver_minor', 'ver_patch', 'build', 'network']
+LABEL_VALUES = ['19', '5', '0', 'stellar-core_19.5.0_abc', 'Public Global Stellar Network ; September 2015']
+BOUNDARIES = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, '+Inf']
+
+
+class TupleRegistry(lib.Registry):
+    # lib.Registry storing a (formatted labels, value) tuple per sample and formatting labels per sample
+    def add(self, name, description, prom_type, label_text, value, suffix=''):
+        name = name + suffix
+        family = self.metrics.get(name)
+        if family is None:
+            family = self.metrics[name] = (description, prom_type, [])
+        family[2].append((label_text, value))
+
+    def family_texts(self):
+        for name, (description, prom_type, samples) in self.metrics.items():
+            lines = [lib.family_header(name, description, prom_type)]
+            for label_text, value in samples:
+                lines.append('{}{{{}}} {}\n'.format(name, label_text, value))
+            yield ''.join(lines)
+
+    def sample_count(self):
+        return sum(len(samples) for _, _, samples in self.metrics.values())
+
+    def labels_text(self, labels):
+        if labels:
+            return lib.format_labels(labels)
+        return self.default_label_text
+
+    def Histogram(self, name, description, bucket, value, labels=None):
+        self.add(name, description, 'histogram',
+                 self.labels_text(labels) + ',le="{}"'.format(bucket), value, '_bucket')
+
+
+def populate(registry, samples):
+    quantile_labels = {q: tuple(zip(LABEL_NAMES + ['quantile'], LABEL_VALUES + [q])) for q in (0.75, 0.99, 1.0)}
+    i = 0
+    # a timer has 5 samples, a histogram 12 and a cursor 1
+    while i // 3 * 18 < samples:
+        name = 'stellar_core_overlay_metric_{}_seconds'.format(i)
+        if i % 3 == 0:
+            # timer
+            registry.Summary(name, 'libmedida metric type: timer', count_value=i, sum_value=i * 0.37)
+            for q in (0.75, 0.99, 1.0):
+                registry.Quantile(name, 'libmedida metric type: timer', value=q * i, labels=quantile_labels[q])
+        elif i % 3 == 1:
+            for n, le in enumerate(BOUNDARIES):
+                registry.Histogram(name, 'libmedida metric type: buckets', bucket=le, value=n * i)
+            registry.Summary(name, 'libmedida metric type: buckets', count_value=i, sum_value=i * 1.5)
+        else:
+            registry.Gauge('stellar_core_active_cursors', 'Stellar core active cursors', value=i,
+                           labels=tuple(zip(LABEL_NAMES + ['cursor_name'], LABEL_VALUES + ['CURSOR{}'.format(i)])))
+        i += 1
+    return registry
+
+
+def measure(label, cls, samples):
+    default_labels = tuple(zip(LABEL_NAMES, LABEL_VALUES))
+    # timings are taken without tracemalloc, it slows down allocations
+    started = time.time()
+    registry = populate(cls(default_labels=default_labels), samples)
+    built = time.time() - started
+    started = time.time()
+    registry.render()
+    rendered = time.time() - started
+    del registry
+
+    tracemalloc.start()
+    registry = populate(cls(default_labels=default_labels), samples)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    output = registry.render()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<8} {:>7} samples {:>7.1f} B/sample {:>7.1f} MiB render peak {:>7.1f} ms build {:>7.1f} ms render'.format(
+        label, registry.sample_count(), float(retained) / registry.sample_count(),
+        (peak - retained - len(output)) / 2.0**20, built * 1000, rendered * 1000))
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    measure('tuples', TupleRegistry, samples)
+    measure('arrays', lib.Registry, samples)
+
+
+if __name__ == "__main__":
+    main()
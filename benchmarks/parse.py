@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Compares peak RSS and time of parsing a /metrics document with json.loads and lib.iter_metrics.
+
+Record a fixture from a live node with `curl -o metrics.json http://127.0.0.1:11626/metrics`,
+a synthetic document is generated when no fixture is given.
+
+Usage: python -m benchmarks.parse [--fixture FILE] [--metrics N]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from stellar_core_prometheus_exporter import lib
+
+from .fake_core import make_metrics
+
+
+def load(content):
+    return json.loads(content)['metrics'].items()
+
+
+def stream(content):
+    lib.ijson = False
+    return lib.iter_metrics(content)
+
+
+def stream_ijson(content):
+    return lib.iter_metrics(content)
+
+
+MODES = [('json.loads', load), ('stdlib', stream)]
+if lib.load_ijson():
+    MODES.append(('ijson', stream_ijson))
+
+
+def run(mode, fixture, results):
+    with open(fixture, 'rb') as f:
+        content = f.read()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    types = {}
+    for name, metric in dict(MODES)[mode](content):
+        types[metric['type']] = types.get(metric['type'], 0) + 1
+    elapsed = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    results.put((elapsed, (after - before) / 1024.0, sum(types.values())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/metrics parsing benchmark')
+    parser.add_argument('--fixture', type=str, help='recorded /metrics document')
+    parser.add_argument('--metrics', type=int, default=5000, help='metrics in the synthetic document')
+    args = parser.parse_args()
+
+    fixture = args.fixture
+    if not fixture:
+        fd, fixture = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(make_metrics(args.metrics), f)
+    print('{}: {:.1f} MiB'.format(args.fixture or 'synthetic document', os.path.getsize(fixture) / 2.0**20))
+
+    # Every mode runs in a fresh process so peak RSS is not shared between them
+    ctx = multiprocessing.get_context('spawn')
+    for mode, _ in MODES:
+        results = ctx.Queue()
+        p = ctx.Process(target=run, args=(mode, fixture, results))
+        p.start()
+        elapsed, rss, count = results.get()
+        p.join()
+        print('{:<10} {:>8.1f} ms {:>8.1f} MiB peak RSS growth, {} metrics'.format(mode, elapsed * 1000, rss, count))
+
+    if not args.fixture:
+        os.unlink(fixture)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Compares lib.Registry.render against the previous string concatenating renderer.
+
+Usage: python -m benchmarks.render [number of bucket metrics]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from stellar_core_prometheus_exporter import lib
+
+
+LABELS = (('ver_major', '19'), ('ver_minor', '5'), ('ver_patch', '0'),
+          ('build', 'stellar-core_19.5.0_abc'), ('network', 'Public Global Stellar Network ; September 2015'))
+BOUNDARIES = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, '+Inf']
+
+
+def legacy_render(samples):
+    # lib.Registry.render before samples were grouped by metric
+    fmt = '# HELP {name} {description}\n# TYPE {name} {prom_type}\n{name}{{{labels}}} {value}\n'
+    txt = ''
+    for m in samples:
+        name, description, labels, prom_type, value = m
+        label_text = ','.join(['{}="{}"'.format(k, v) for k, v in labels])
+        txt += fmt.format(description=description,
+                          name=name,
+                          labels=label_text,
+                          prom_type=prom_type,
+                          value=value,
+                          )
+    return txt.encode('utf-8')
+
+
+def legacy_samples(count):
+    samples = []
+    for i in range(count):
+        name = 'stellar_core_overlay_metric_{}_seconds'.format(i)
+        for n, le in enumerate(BOUNDARIES):
+            samples.append((name + '_bucket', 'libmedida metric type: buckets',
+                            LABELS + (('le', le),), 'histogram', n * 10))
+        samples.append((name + '_count', 'libmedida metric type: buckets', LABELS, 'summary', 100))
+        samples.append((name + '_sum', 'libmedida metric type: buckets', LABELS, 'summary', 1.5))
+    return samples
+
+
+def registry(count):
+    r = lib.Registry(default_labels=LABELS)
+    for i in range(count):
+        name = 'stellar_core_overlay_metric_{}_seconds'.format(i)
+        for n, le in enumerate(BOUNDARIES):
+            r.Histogram(name, 'libmedida metric type: buckets', bucket=le, value=n * 10)
+        r.Summary(name, 'libmedida metric type: buckets', count_value=100, sum_value=1.5)
+    return r
+
+
+class NullWriter(object):
+    # stands in for the socket of a scrape
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def measure(label, func, *args):
+    started = time.time()
+    func(*args)
+    elapsed = time.time() - started
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<10} {:>8.1f} ms {:>8.1f} MiB peak'.format(label, elapsed * 1000, peak / 2.0**20))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print('{} bucket metrics, {} samples'.format(count, count * (len(BOUNDARIES) + 2)))
+    measure('legacy', legacy_render, legacy_samples(count))
+    r = registry(count)
+    measure('render', r.render)
+    measure('write', r.write, NullWriter())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Measures exporter cold start against a startup time budget.
+
+Reports the import time of the exporter module measured by `python -X importtime` in fresh
+interpreters, the modules it spends most time importing, and the time from starting an exporter
+process to its first successful scrape of a local fake stellar-core. The exit status is 1 if the
+median import time exceeds the budget.
+
+Usage: python -m benchmarks.startup [--runs N] [--budget MS] [--top N]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+from urllib.request import urlopen
+
+from .fake_core import FakeCore
+from .load import free_port
+
+MODULE = 'stellar_core_prometheus_exporter.exporter'
+
+
+def import_times():
+    # Returns cumulative import time in ms of MODULE and every module imported by it in a fresh interpreter
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + MODULE],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    times = {}
+    # Lines are "import time: self [us] | cumulative | imported package" with nested imports indented,
+    # listed before the module importing them
+    for line in reversed(output.splitlines()):
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        if times and fields[2].startswith(' ' + name):
+            # Next module at the top level, imported before MODULE
+            break
+        if times or name == MODULE:
+            times[name] = int(fields[1]) / 1000.0
+    return times
+
+
+def first_scrape(core_address):
+    # Returns seconds from starting an exporter process to its first successful scrape
+    port = free_port()
+    started = time.time()
+    process = subprocess.Popen([sys.executable, '-m', MODULE,
+                                '--stellar-core-address', core_address, '--port', str(port)])
+    try:
+        deadline = started + 10
+        while time.time() < deadline:
+            try:
+                urlopen('http://127.0.0.1:{}/metrics'.format(port), timeout=5).read()
+                return time.time() - started
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError('exporter did not start')
+    finally:
+        process.kill()
+        process.wait()
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='exporter startup benchmark')
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters measured')
+    parser.add_argument('--budget', type=float, default=75, help='budget of the median import time in ms')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imported modules listed')
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    total = median([times[MODULE] for times in runs])
+    print('{:<50} {:>8.1f} ms median of {} runs, budget {:.1f} ms'.format(MODULE, total, args.runs, args.budget))
+    modules = set(runs[0]).difference([MODULE])
+    slowest = sorted(modules, key=lambda m: -median([times.get(m, 0) for times in runs]))[:args.top]
+    for module in slowest:
+        print('  {:<48} {:>8.1f} ms'.format(module, median([times.get(module, 0) for times in runs])))
+
+    core = FakeCore(0).start()
+    try:
+        scrapes = [first_scrape(core.address) for _ in range(min(args.runs, 5))]
+    finally:
+        core.shutdown()
+        core.server_close()
+    print('{:<50} {:>8.1f} ms median'.format('start to first scrape', median(scrapes) * 1000))
+
+    if total > args.budget:
+        print('FAILED import time {:.1f} ms exceeds the budget of {:.1f} ms'.format(total, args.budget))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
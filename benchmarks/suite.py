@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Benchmark suite run against local fake stellar-cores, usable as a regression gate.
+
+Every scenario starts a fake core and an exporter process and reports scrapes/s, p50/p99 scrape
+latency, exporter CPU time per scrape and peak RSS. Scenarios with a failing core expect every
+scrape to be answered with an error status, the others with metrics in the requested format.
+Results can be saved and later runs compared against them, the exit status is 1 if a scenario had
+failed scrapes or regressed by more than the tolerance.
+
+Usage: python -m benchmarks.suite [--scrapers N] [--scrapes N] [--fixtures DIR]
+                                  [--save FILE] [--compare FILE] [--tolerance FRACTION]
+"""
+
+import argparse
+import json
+import sys
+
+from .fake_core import FakeCore
+from .load import report, run
+
+
+PROTOBUF = 'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited'
+OPENMETRICS = 'application/openmetrics-text; version=1.0.0'
+
+# name, fake core arguments, exporter arguments, scrape request headers, expected status of scrapes
+SCENARIOS = [
+    ('threading', {}, [], {}, 200),
+    ('asyncio', {}, ['--asyncio'], {}, 200),
+    ('poll', {}, ['--poll-interval', '1'], {}, 200),
+    ('workers', {}, ['--poll-interval', '1', '--workers', '2'], {}, 200),
+    ('workers-no-gzip', {}, ['--poll-interval', '1', '--workers', '2', '--gzip-level', '0', '--openmetrics'],
+     {'Accept': OPENMETRICS, 'Accept-Encoding': 'gzip'}, 200),
+    ('gzip', {}, [], {'Accept-Encoding': 'gzip'}, 200),
+    ('openmetrics', {}, ['--openmetrics'], {'Accept': OPENMETRICS}, 200),
+    ('protobuf', {}, ['--native-histogram-schema', '3'], {'Accept': PROTOBUF}, 200),
+    ('large', {'metrics': 5000, 'cursors': 100}, [], {}, 200),
+    ('cursor-overflow', {'cursors': 2000}, ['--max-cursor-series', '100'], {}, 200),
+    ('slow-core', {'latency': 0.2}, [], {}, 200),
+    ('old-quorum', {'old_quorum': True}, [], {}, 200),
+    ('no-getcursor', {'getcursor': False}, [], {}, 200),
+    # A core failing /metrics must be reported to scrapers as 504 in every serving mode
+    ('failing-core', {'metrics_status': 500}, [], {}, 504),
+    ('failing-asyncio', {'metrics_status': 500}, ['--asyncio'], {}, 504),
+    ('failing-asyncio-poll', {'metrics_status': 500}, ['--asyncio', '--poll-interval', '1'], {}, 504),
+    ('failing-workers', {'metrics_status': 500}, ['--poll-interval', '1', '--workers', '2'], {}, 504),
+]
+
+def media_type(headers):
+    # Returns the media type of metrics served for scrape request headers
+    accept = headers.get('Accept', '')
+    if accept.startswith('application/vnd.google.protobuf'):
+        return 'application/vnd.google.protobuf'
+    if accept.startswith('application/openmetrics-text'):
+        return 'application/openmetrics-text'
+    return 'text/plain'
+
+
+# result -> whether higher values are better
+CHECKS = {'scrapes_per_second': True, 'p99_ms': False, 'cpu_ms_per_scrape': False, 'rss_mib': False}
+
+
+def regressions(name, result, baseline, tolerance):
+    # Returns descriptions of results worse than baseline by more than tolerance
+    found = []
+    if result['errors']:
+        found.append('{}: {} failed scrapes, first: {}'.format(name, result['errors'], result['first_error']))
+    if baseline is None or 'p50_ms' not in result:
+        return found
+    for key, higher_is_better in CHECKS.items():
+        if key not in baseline:
+            continue
+        if higher_is_better:
+            regressed = result[key] < baseline[key] * (1 - tolerance)
+        else:
+            regressed = result[key] > baseline[key] * (1 + tolerance)
+        if regressed:
+            found.append('{}: {} {:.1f}, baseline {:.1f}'.format(name, key, result[key], baseline[key]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='exporter benchmark suite')
+    parser.add_argument('--scrapers', type=int, default=10, help='number of concurrent scrapers')
+    parser.add_argument('--scrapes', type=int, default=20, help='scrapes per scraper')
+    parser.add_argument('--metrics', type=int, default=1000, help='number of metrics served by the fake core')
+    parser.add_argument('--fixtures', type=str, help='also run a scenario replaying fixtures recorded from a live node')
+    parser.add_argument('--save', type=str, help='write results to this JSON file')
+    parser.add_argument('--compare', type=str, help='compare results with a file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction by which results may be worse than the compared ones')
+    args = parser.parse_args()
+
+    scenarios = list(SCENARIOS)
+    if args.fixtures:
+        scenarios.append(('fixtures', {'fixtures': args.fixtures}, [], {}, 200))
+    baselines = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baselines = json.load(f)
+
+    print('{} scrapers x {} scrapes, {} core metrics'.format(args.scrapers, args.scrapes, args.metrics))
+    results = {}
+    failures = []
+    for name, core_args, exporter_args, headers, status in scenarios:
+        core_args = dict({'metrics': args.metrics}, **core_args)
+        core = FakeCore(0, **core_args).start()
+        try:
+            results[name] = run(core.address, exporter_args, args.scrapers, args.scrapes, headers, status,
+                                media_type(headers) if status == 200 else None)
+        finally:
+            core.shutdown()
+            core.server_close()
+        report(name, results[name])
+        failures.extend(regressions(name, results[name], baselines.get(name), args.tolerance))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    for failure in failures:
+        print('FAILED ' + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
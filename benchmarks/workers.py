@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Measures scrape throughput of the exporter by number of --workers processes.
+
+Every configuration polls a local fake stellar-core and is scraped by client processes for a
+fixed duration, so clients are not limited by the GIL of a single process. The single process
+polling mode is measured as workers 0. Scaling needs as many CPU cores as workers and clients.
+Linux only, process stats are read from /proc.
+
+Usage: python -m benchmarks.workers [--workers 0,1,2,4] [--clients N] [--duration SECONDS] [--metrics N] [--gzip]
+"""
+
+import argparse
+import multiprocessing
+import time
+from urllib.request import Request, urlopen
+
+from .fake_core import FakeCore
+from .load import percentile, process_cpu, process_tree, start_exporter, stop
+
+
+def client(url, headers, duration, results):
+    # Scrapes url until duration passed, puts latencies and the number of errors
+    latencies = []
+    errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        started = time.time()
+        try:
+            urlopen(Request(url, headers=headers), timeout=30).read()
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.time() - started)
+    results.put((latencies, errors))
+
+
+def run(core_address, workers, clients, duration, headers):
+    extra_args = ['--poll-interval', '1']
+    if workers:
+        extra_args += ['--workers', str(workers)]
+    process, url = start_exporter(core_address, extra_args)
+    # Workers serve 503 until the first snapshot is published
+    deadline = time.time() + 10
+    while True:
+        try:
+            urlopen(Request(url, headers=headers), timeout=30).read()
+            break
+        except Exception:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+    pids = process_tree(process.pid)
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    processes = [ctx.Process(target=client, args=(url, headers, duration, results)) for _ in range(clients)]
+    for p in processes:
+        p.start()
+    # Clients start measuring once their interpreter is up, CPU time is counted from then on
+    time.sleep(0.5)
+    cpu = sum(process_cpu(pid) for pid in pids)
+    latencies = []
+    errors = 0
+    for _ in processes:
+        client_latencies, client_errors = results.get()
+        latencies.extend(client_latencies)
+        errors += client_errors
+    cpu = sum(process_cpu(pid) for pid in pids) - cpu
+    for p in processes:
+        p.join()
+    stop(pids)
+    process.wait()
+
+    print('workers {:>2} {:>8.1f} scrapes/s  p50 {:>7.1f} ms  p99 {:>7.1f} ms  cpu {:>6.2f} ms/scrape  errors {}'.format(
+        workers, len(latencies) / float(duration), percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000, cpu * 1000 / max(1, len(latencies)), errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='exporter worker processes scaling benchmark')
+    parser.add_argument('--workers', type=str, default='0,1,2,4', help='comma separated worker counts')
+    parser.add_argument('--clients', type=int, default=8, help='number of scraping processes')
+    parser.add_argument('--duration', type=float, default=5, help='seconds every configuration is scraped')
+    parser.add_argument('--metrics', type=int, default=1000, help='number of metrics served by the fake core')
+    parser.add_argument('--gzip', action='store_true', help='request gzip compressed responses')
+    args = parser.parse_args()
+
+    headers = {'Accept-Encoding': 'gzip'} if args.gzip else {}
+    print('{} CPUs, {} client processes, {} core metrics'.format(
+        multiprocessing.cpu_count(), args.clients, args.metrics))
+    core = FakeCore(0, metrics=args.metrics).start()
+    try:
+        for workers in args.workers.split(','):
+            run(core.address, int(workers), args.clients, args.duration, headers)
+    finally:
+        core.shutdown()
+        core.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -21,10 +21,13 @@ setuptools.setup(
         ],
     },
     packages=setuptools.find_packages(),
+    python_requires=">=3.7",
     install_requires=["requests"],
+    extras_require={
+        "ijson": ["ijson>=3.1"],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
-        "Programming Language :: Python :: 2",
         "Programming Language :: Python :: 3",
         "Intended Audience :: Information Technology",
         "Topic :: System :: Monitoring",
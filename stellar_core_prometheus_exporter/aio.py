@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""asyncio serving mode.
+
+Scrapes are served from a single event loop. Requests to stellar-core are made with a
+small non-blocking HTTP client, or with requests in threads for addresses with credentials
+or behind a proxy, and concurrent scrapes of the same target share one in-flight collection.
+"""
+
+import asyncio
+import socket
+import time
+from http import HTTPStatus
+from urllib.parse import urlparse
+
+from . import lib
+from .exporter import (CollectionError, RequestsPool, StellarCoreHandler, accepts_gzip, exporter_metrics, find_target,
+                       needs_requests, scrape_tail)
+
+
+class CoreClient(object):
+    """Minimal non-blocking HTTP/1.1 GET client for the stellar-core admin endpoint.
+
+    Keeps up to pool_size idle keep-alive connections to the core.
+    """
+    def __init__(self, core_address, pool_size):
+        url = urlparse(core_address)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.ssl = url.scheme == 'https' or None
+        self.pool_size = pool_size
+        self.idle = []
+
+    async def get(self, url, timeout):
+        # Returns status code and body of the response
+        url = urlparse(url)
+        path = url.path or '/'
+        if url.query:
+            path = path + '?' + url.query
+        return await asyncio.wait_for(self.request(path), timeout)
+
+    async def request(self, path):
+        reused = bool(self.idle)
+        if reused:
+            reader, writer = self.idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        try:
+            status, keep_alive, body = await self.exchange(reader, writer, path)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            if reused:
+                # Core closed the idle connection, retry on a new one
+                return await self.request(path)
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive and len(self.idle) < self.pool_size:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, body
+
+    async def exchange(self, reader, writer, path):
+        writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(path, self.host).encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed by {}'.format(self.host))
+        version, status = status_line.split(None, 2)[:2]
+        headers = await read_headers(reader)
+        keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await read_headers(reader)  # trailers
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return int(status), keep_alive, body
+
+
+class ExecutorClient(object):
+    """CoreClient counterpart making blocking requests with exporter.RequestsPool in executor threads.
+
+    Used for core addresses with credentials or behind a proxy, see exporter.needs_requests.
+    """
+    def __init__(self, core_address, pool_size):
+        self.pool = RequestsPool(core_address, pool_size)
+
+    async def get(self, url, timeout):
+        # Returns status code and body of the response
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self.pool.get, url, timeout)
+        except socket.timeout:
+            raise asyncio.TimeoutError()
+
+
+async def read_headers(reader):
+    # Reads header lines up to the empty line, returns lowercase header names mapped to values
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+class AsyncCollector(object):
+    """Collects a target with non-blocking requests, concurrent scrapes share one collection."""
+    def __init__(self, collector, upstream_limit, gzip_level=6, native_histogram_schema=None, openmetrics=False):
+        self.collector = collector
+        self.upstream_limit = upstream_limit
+        self.gzip_level = gzip_level
+        self.native_histogram_schema = native_histogram_schema
+        self.openmetrics = openmetrics
+        if needs_requests(collector.core_address):
+            self.client = ExecutorClient(collector.core_address, pool_size=3)
+        else:
+            self.client = CoreClient(collector.core_address, pool_size=3)
+        self.inflight = None
+        self.last = None
+        self.last_time = 0
+
+    async def fetch(self, url, timeout):
+        endpoint = self.collector.endpoint_names[url]
+        async with self.upstream_limit:
+            started = time.time()
+            try:
+                status, content = await self.client.get(url, timeout)
+            except asyncio.TimeoutError:
+                raise CollectionError(504, 'Error retrieving data from {}'.format(url),
+                                      endpoint=endpoint, reason='timeout')
+            except (OSError, EOFError, ValueError):
+                raise CollectionError(504, 'Error retrieving data from {}'.format(url),
+                                      endpoint=endpoint, reason='connection')
+        self.collector.fetched(url, started, content)
+        return status, content
+
+    async def collect_output(self):
+        c = self.collector
+        started = time.time()
+        responses = await asyncio.gather(self.fetch(c.metrics_url, c.metrics_timeout),
+                                         self.fetch(c.info_url, c.info_timeout),
+                                         self.fetch(c.cursors_url, c.cursors_timeout),
+                                         return_exceptions=True)
+        try:
+            for response in responses:
+                if isinstance(response, BaseException):
+                    raise response
+            c.phase('fetch', started)
+            # Parsing and rendering are CPU bound, keep them off the event loop
+            registry = await asyncio.get_running_loop().run_in_executor(None, self.render, responses)
+        except Exception as e:
+            c.count_error(e)
+            raise
+        self.last = registry
+        self.last_time = time.time()
+        return registry
+
+    def render(self, responses):
+        registry = self.collector.to_registry(*responses)
+        started = time.time()
+        # Other formats are rendered on first request
+        registry.output(self.gzip_level)
+        self.collector.phase('render', started)
+        return registry
+
+    def body(self, registry, source, fmt, gzip):
+        # Returns the response body of a scrape and its uncompressed size
+        output = registry.output(self.gzip_level, fmt, self.native_histogram_schema)
+        tail = scrape_tail(source, fmt, self.native_histogram_schema)
+        if gzip:
+            return output.gzip(tail), len(output.data) + len(tail)
+        return output.data + tail, len(output.data) + len(tail)
+
+    async def collect(self):
+        """Returns the collected lib.Registry, joining the collection in progress if there is one.
+
+        Like exporter.Collector.collect() the previous output is reused within min_interval.
+        """
+        if self.last is not None and time.time() - self.last_time < self.collector.min_interval:
+            self.coalesced()
+            return self.last
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self.collect_output())
+            self.inflight.add_done_callback(self.done)
+        else:
+            self.coalesced()
+        # A scraper going away must not cancel the collection for the others
+        return await asyncio.shield(self.inflight)
+
+    def done(self, future):
+        self.inflight = None
+
+    def exporter_metrics(self, registry, labels=()):
+        self.collector.exporter_metrics(registry, labels)
+
+    def coalesced(self):
+        with self.collector.lock:
+            self.collector.coalesced += 1
+
+
+async def handle(reader, writer, targets):
+    try:
+        request_line = await reader.readline()
+        headers = await read_headers(reader)
+        parts = request_line.decode('latin-1').split()
+        if len(parts) < 2 or parts[0] != 'GET':
+            code, output = 501, b'Unsupported method\n'
+        elif urlparse(parts[1]).path == '/exporter-metrics':
+            code, output = 200, exporter_metrics(targets)
+        else:
+            try:
+                collector, poller = find_target(targets, parts[1])
+            except CollectionError as e:
+                code, output = e.code, '{}\n'.format(e.msg).encode('utf-8')
+            else:
+                await scrape(writer, collector, poller, lib.negotiate(headers.get('accept'), collector.openmetrics),
+                             accepts_gzip(headers.get('accept-encoding')))
+                return
+        await respond(writer, code, output)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def scrape(writer, async_collector, poller, fmt, gzip):
+    collector = async_collector.collector
+    collector.scrape_started()
+    try:
+        try:
+            if poller:
+                registry = poller.snapshot()
+            else:
+                registry = await async_collector.collect()
+        except CollectionError as e:
+            await respond(writer, e.code, '{}\n'.format(e.msg).encode('utf-8'))
+            return
+        gzip = gzip and async_collector.gzip_level
+        started = time.time()
+        # Rendering other formats and compression are CPU bound, keep them off the event loop
+        body, size = await asyncio.get_running_loop().run_in_executor(
+            None, async_collector.body, registry, poller or async_collector, fmt, gzip)
+        await respond(writer, 200, body, lib.CONTENT_TYPES[fmt], 'gzip' if gzip else None)
+        if gzip:
+            collector.response_sizes(size, len(body))
+        else:
+            collector.response_sizes(size)
+        collector.phase('write', started)
+    finally:
+        collector.scrape_finished()
+
+
+async def respond(writer, code, output, content_type=StellarCoreHandler.content_type, encoding=None):
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'.format(
+        code, HTTPStatus(code).phrase, content_type, len(output))
+    if encoding:
+        head += 'Content-Encoding: {}\r\n'.format(encoding)
+    writer.write(head.encode('latin-1') + b'Connection: close\r\n\r\n' + output)
+    await writer.drain()
+
+
+async def serve_forever(port, targets, max_upstream_requests, gzip_level, native_histogram_schema, openmetrics):
+    upstream_limit = asyncio.Semaphore(max_upstream_requests)
+    async_targets = {}
+    for name, (collector, poller) in targets.items():
+        async_targets[name] = (AsyncCollector(collector, upstream_limit, gzip_level, native_histogram_schema,
+                                              openmetrics), poller)
+    server = await asyncio.start_server(lambda r, w: handle(r, w, async_targets), '', port)
+    async with server:
+        await server.serve_forever()
+
+
+def serve(port, targets, max_upstream_requests, gzip_level=6, native_histogram_schema=None, openmetrics=False):
+    """Serves targets, a dict of target name to (exporter.Collector, exporter.Poller or None).
+
+    gzip_level 0 disables compression of responses, native_histogram_schema adds native
+    histograms to responses in the protobuf format and openmetrics serves the OpenMetrics
+    format to scrapers preferring it.
+    """
+    asyncio.run(serve_forever(port, targets, max_upstream_requests, gzip_level, native_histogram_schema,
+                              openmetrics))
@@ -2,35 +2,23 @@
 # vim: tabstop=4 expandtab shiftwidth=4
 
 import argparse
-import requests
+import json
 import re
+import socket
 import time
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from http.client import HTTPConnection, HTTPException
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from os import environ
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
 from . import lib
+from .presets import PRESETS
 
-
-try:
-    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-    from SocketServer import ThreadingMixIn
-except ImportError:
-    # Python 3
-    unicode = str
-    from http.server import BaseHTTPRequestHandler, HTTPServer
-    from socketserver import ThreadingMixIn
-
-
-parser = argparse.ArgumentParser(description='simple stellar-core Prometheus exporter/scraper')
-parser.add_argument('--stellar-core-address', type=str,
-                    help='Stellar core address. Defaults to STELLAR_CORE_ADDRESS environment '
-                         'variable or if not set to http://127.0.0.1:11626',
-                    default=environ.get('STELLAR_CORE_ADDRESS', 'http://127.0.0.1:11626'))
-parser.add_argument('--port', type=int,
-                    help='HTTP bind port. Defaults to PORT environment variable '
-                         'or if not set to 9473',
-                    default=int(environ.get('PORT', '9473')))
-args = parser.parse_args()
+# Value of derived metrics which can not be computed
+NAN = float('nan')
 
 
 class _ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
@@ -39,16 +27,191 @@ class _ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
 
 
-class StellarCoreHandler(BaseHTTPRequestHandler):
+class CollectionError(Exception):
+    """Metrics could not be collected, code is the HTTP status served to the scraper.
+
+    endpoint and reason describe the failure in the stellar_core_exporter_errors_total metric.
+    """
+    def __init__(self, code, msg, endpoint='', reason='error'):
+        super(CollectionError, self).__init__(msg)
+        self.code = code
+        self.msg = msg
+        self.endpoint = endpoint
+        self.reason = reason
+
+
+def needs_requests(core_address):
+    """Returns whether core_address must be requested with requests rather than a plain HTTP client.
+
+    The plain clients neither send credentials of the address nor use proxies, like requests does
+    with proxies configured by http_proxy, https_proxy or all_proxy environment variables unless
+    no_proxy excludes the core.
+    """
+    url = urlparse(core_address)
+    if url.username is not None:
+        return True
+    names = (url.scheme + '_proxy', 'all_proxy')
+    if not any(environ.get(name) or environ.get(name.upper()) for name in names):
+        return False
+    # urllib.request takes a while to import, only needed with proxies configured
+    import urllib.request
+    return not urllib.request.proxy_bypass_environment(url.netloc)
+
+
+class ConnectionPool(object):
+    """Keep-alive connections to a plain HTTP stellar-core admin endpoint, made with http.client.
+
+    Shared by the fetching threads of a collector, keeps up to pool_size idle connections.
+    """
+    def __init__(self, core_address, pool_size):
+        url = urlparse(core_address)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.pool_size = pool_size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self, url, timeout):
+        """Returns status code and body of the response.
+
+        Raises socket.timeout on timeouts, OSError or HTTPException if the request failed.
+        """
+        url = urlparse(url)
+        path = url.path or '/'
+        if url.query:
+            path = path + '?' + url.query
+        return self.request(path, timeout)
+
+    def request(self, path, timeout):
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        reused = connection is not None
+        if reused:
+            connection.timeout = timeout
+            connection.sock.settimeout(timeout)
+        else:
+            connection = HTTPConnection(self.host, self.port, timeout=timeout)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+        except socket.timeout:
+            connection.close()
+            raise
+        except (socket.error, HTTPException):
+            connection.close()
+            if reused:
+                # Core closed the idle connection, retry on a new one
+                return self.request(path, timeout)
+            raise
+        with self.lock:
+            keep = not response.will_close and len(self.idle) < self.pool_size
+            if keep:
+                self.idle.append(connection)
+        if not keep:
+            connection.close()
+        return response.status, body
+
+
+class RequestsPool(object):
+    """ConnectionPool counterpart made with requests, used for https addresses and for needs_requests ones.
+
+    requests is imported on first use, it takes longer to import than the rest of the exporter.
+    """
+    def __init__(self, core_address, pool_size):
+        import requests
+        import requests.adapters
+        self.requests = requests
+        self.session = requests.Session()
+        self.session.mount(core_address, requests.adapters.HTTPAdapter(pool_connections=1,
+                                                                        pool_maxsize=pool_size))
+
+    def get(self, url, timeout):
+        # Other requests exceptions are IOErrors already
+        try:
+            response = self.session.get(url, timeout=timeout)
+        except self.requests.Timeout as e:
+            raise socket.timeout(str(e))
+        return response.status_code, response.content
+
+
+class Collector(object):
+    """Fetches data from a single stellar-core and renders it in Prometheus format.
+
+    All endpoints are requested concurrently over a pool of keep-alive connections, upstream_limit
+    optionally bounds in-flight requests shared with other collectors. Concurrent calls to collect()
+    share one collection, so at most one collection per core is in progress.
+    """
+    # Upper bound of cached metric name translations, core exposes roughly a thousand metrics
+    name_cache_size = 4096
+
+    def __init__(self, core_address, metrics_timeout=10, info_timeout=5, cursors_timeout=5,
+                 upstream_limit=None, min_interval=0, metric_filter=None, max_cursor_series=100,
+                 max_critical_series=20, derived_filter=None, derived_window=60):
+        self.core_address = core_address
+        self.info_url = core_address + '/info'
+        self.metrics_url = core_address + '/metrics'
+        self.cursors_url = core_address + '/getcursor'
+        self.metrics_timeout = metrics_timeout
+        self.info_timeout = info_timeout
+        self.cursors_timeout = cursors_timeout
+        # A collection needs one connection and worker per endpoint
+        pool_size = 3
+        if urlparse(core_address).scheme == 'http' and not needs_requests(core_address):
+            self.pool = ConnectionPool(core_address, pool_size)
+        else:
+            self.pool = RequestsPool(core_address, pool_size)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.upstream_limit = upstream_limit or threading.BoundedSemaphore(pool_size)
+        self.min_interval = min_interval
+        self.metric_filter = metric_filter
+        self.cursor_limit = lib.SeriesLimit(max_cursor_series)
+        self.critical_limit = lib.SeriesLimit(max_critical_series)
+        # Metrics matching derived_filter are also exported as rates and windowed changes
+        self.derived_filter = derived_filter
+        self.derived_window = lib.RateWindow(derived_window) if derived_filter else None
+        self.endpoint_names = {self.metrics_url: 'metrics', self.info_url: 'info', self.cursors_url: 'getcursor'}
+        self.stats = lib.Stats()
+        self.lock = threading.Lock()
+        self.inflight = None
+        self.last = None
+        self.last_time = 0
+        self.coalesced = 0
+        self.info_keys = ['ledger', 'network', 'peers', 'protocol_version', 'quorum', 'startedOn', 'state']
+        self.state_metrics = ['booting', 'joining scp', 'connected', 'catching up', 'synced', 'stopping']
+        self.ledger_metrics = {'age': 'age', 'baseFee': 'base_fee', 'baseReserve': 'base_reserve',
+                               'closeTime': 'close_time', 'maxTxSetSize': 'max_tx_set_size',
+                               'num': 'num', 'version': 'version'}
+        self.quorum_metrics = ['agree', 'delayed', 'disagree', 'fail_at', 'missing']
+        self.quorum_phase_metrics = ['unknown', 'prepare', 'confirm', 'externalize']
+        # Examples:
+        #   "stellar-core 11.1.0-unstablerc2 (324c1bd61b0e9bada63e0d696d799421b00a7950)"
+        #   "stellar-core 11.1.0 (324c1bd61b0e9bada63e0d696d799421b00a7950)"
+        #   "v11.1.0"
+        self.build_regex = re.compile(r'(stellar-core|v) ?(\d+)\.(\d+)\.(\d+).*$')
+
+        self.label_names = ["ver_major", "ver_minor", "ver_patch", "build", "network"]
+
+        self.name_regex = re.compile(r'\.|-|\s')
+        self.converters = {
+            'timer': self.timer_to_metrics,
+            'histogram': self.histogram_to_metrics,
+            'counter': self.counter_to_metrics,
+            'meter': self.meter_to_metrics,
+            'buckets': self.buckets_to_metrics,
+        }
+        self.name_cache = lib.LRUCache(self.translate, self.name_cache_size)
+        self.derived_names = lib.LRUCache(self.derived_translate, self.name_cache_size)
+        # Series of the previous collection, only values are stored while they do not change
+        self.layout = lib.Layout()
+
     def log_message(self, format, *args):
         return
 
-    def get_labels(self):
+    def get_labels(self, info):
         try:
-            response = requests.get(self.info_url)
-            json = response.json()
-            build = json['info']['build']
-            network = json['info']['network']
+            build = info['build']
+            network = info['network']
         except Exception:
             return ['unknown', 'unknown', 'unknown', 'unknown', 'unknown']
         match = self.build_regex.match(build)
@@ -67,191 +230,355 @@ class StellarCoreHandler(BaseHTTPRequestHandler):
         ]
         return labels
 
-    def buckets_to_metrics(self, metric_name, buckets):
-        # Converts raw bucket metric into sorted list of buckets
-        unit = buckets['boundary_unit']
-        description = 'libmedida metric type: ' + buckets['type']
-
-        measurements = []
-        for bucket in buckets['buckets']:
-            measurements.append({
-                'boundary': lib.duration_to_seconds(bucket['boundary'], unit),
-                'count': bucket['count'],
-                'sum': bucket['sum']
-                }
-            )
-        count_value = 0
-        sum_value = 0
-        for m in sorted(measurements, key=lambda i: i['boundary']):
-            # Buckets from core contain only values from their respective ranges.
-            # Prometheus expects "le" buckets to be cummulative so we need some extra math
-            count_value += m['count']
-            sum_value += lib.duration_to_seconds(m['sum'], unit)
-
-            # Treat buckets larger than 30d as infinity
-            if float(m['boundary']) > 30 * 86400:
-                bucket = '+Inf'
+    def buckets_to_metrics(self, registry, quantile_labels, metric_name, description, metric):
+        # We have a bucket, this is a Prometheus Histogram
+        bounds, counts, count_value, sum_value = lib.bucket_counts(metric)
+        for boundary, cumulative in zip(bounds, counts):
+            registry.Histogram(metric_name, description,
+                               bucket=boundary,
+                               value=cumulative,
+                               )
+        registry.Summary(metric_name, description,
+                         count_value=count_value,
+                         sum_value=sum_value,
+                         prom_type='histogram',
+                         )
+
+    def collect(self):
+        """Collects all metrics from core and returns them in a lib.Registry.
+
+        Raises CollectionError if core could not be queried or returned unusable data.
+        Callers arriving while a collection is in progress, or less than min_interval seconds
+        after it finished, get its result.
+        """
+        with self.lock:
+            if self.last and time.time() - self.last_time < self.min_interval:
+                self.coalesced += 1
+                return self.last
+            leader = self.inflight is None
+            if leader:
+                self.inflight = Future()
             else:
-                bucket = m['boundary']
-
-            self.registry.Histogram(metric_name, description,
-                                    bucket=bucket,
-                                    value=count_value,
-                                    )
-        self.registry.Summary(metric_name, description,
-                              count_value=count_value,
-                              sum_value=sum_value,
-                              )
+                self.coalesced += 1
+            future = self.inflight
+        if not leader:
+            return future.result()
 
-    def set_vars(self):
-        self.info_url = args.stellar_core_address + '/info'
-        self.metrics_url = args.stellar_core_address + '/metrics'
-        self.cursors_url = args.stellar_core_address + '/getcursor'
-        self.info_keys = ['ledger', 'network', 'peers', 'protocol_version', 'quorum', 'startedOn', 'state']
-        self.state_metrics = ['booting', 'joining scp', 'connected', 'catching up', 'synced', 'stopping']
-        self.ledger_metrics = {'age': 'age', 'baseFee': 'base_fee', 'baseReserve': 'base_reserve',
-                               'closeTime': 'close_time', 'maxTxSetSize': 'max_tx_set_size',
-                               'num': 'num', 'version': 'version'}
-        self.quorum_metrics = ['agree', 'delayed', 'disagree', 'fail_at', 'missing']
-        self.quorum_phase_metrics = ['unknown', 'prepare', 'confirm', 'externalize']
-        # Examples:
-        #   "stellar-core 11.1.0-unstablerc2 (324c1bd61b0e9bada63e0d696d799421b00a7950)"
-        #   "stellar-core 11.1.0 (324c1bd61b0e9bada63e0d696d799421b00a7950)"
-        #   "v11.1.0"
-        self.build_regex = re.compile(r'(stellar-core|v) ?(\d+)\.(\d+)\.(\d+).*$')
+        try:
+            registry = self.collect_registry()
+        except Exception as e:
+            self.count_error(e)
+            with self.lock:
+                self.inflight = None
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.inflight = None
+            self.last = registry
+            self.last_time = time.time()
+        future.set_result(registry)
+        return registry
 
-        self.label_names = ["ver_major", "ver_minor", "ver_patch", "build", "network"]
-        self.labels = self.get_labels()
-        self.registry = lib.Registry(default_labels=tuple(zip(self.label_names, self.labels)))
-        self.content_type = str('text/plain; version=0.0.4; charset=utf-8')
+    def fetch(self, url, timeout):
+        # Returns status code and body of the response
+        with self.upstream_limit:
+            started = time.time()
+            status, content = self.pool.get(url, timeout)
+        self.fetched(url, started, content)
+        return status, content
 
-    def error(self, code, msg):
-        self.send_response(code)
-        self.send_header('Content-Type', self.content_type)
-        self.end_headers()
-        self.wfile.write('{}\n'.format(msg).encode('utf-8'))
+    def fetched(self, url, started, content):
+        # Records duration and size of a stellar-core response
+        labels = (('endpoint', self.endpoint_names[url]),)
+        self.stats.observe('stellar_core_exporter_upstream_duration_seconds',
+                           'Duration of requests to stellar-core',
+                           time.time() - started, labels)
+        self.stats.set('stellar_core_exporter_upstream_response_bytes',
+                       'Size of the last response from stellar-core',
+                       len(content), labels)
 
-    def do_GET(self):
-        self.set_vars()
+    def phase(self, phase, started):
+        # Records duration of a scrape phase started at started
+        self.stats.observe('stellar_core_exporter_phase_duration_seconds',
+                           'Duration of scrape phases: fetch from stellar-core, decode of /info and /getcursor, '
+                           'parsing and conversion of /metrics, render of the exposition and write to the scraper',
+                           time.time() - started, (('phase', phase),))
+
+    def count_error(self, e):
+        if isinstance(e, CollectionError):
+            labels = (('endpoint', e.endpoint), ('reason', e.reason))
+        else:
+            labels = (('endpoint', ''), ('reason', 'exception'))
+        self.stats.inc('stellar_core_exporter_errors_total', 'Failed collections by endpoint and reason', labels)
+
+    def collect_registry(self):
+        started = time.time()
+        metrics_future = self.executor.submit(self.fetch, self.metrics_url, self.metrics_timeout)
+        info_future = self.executor.submit(self.fetch, self.info_url, self.info_timeout)
+        cursors_future = self.executor.submit(self.fetch, self.cursors_url, self.cursors_timeout)
+        responses = (self.response(metrics_future, self.metrics_url),
+                     self.response(info_future, self.info_url),
+                     self.response(cursors_future, self.cursors_url))
+        self.phase('fetch', started)
+        return self.to_registry(*responses)
+
+    def to_registry(self, metrics_response, info_response, cursors_response):
+        """Converts (status code, body) responses of the core endpoints into a lib.Registry."""
+        status, content = metrics_response
+        if status >= 400:
+            raise CollectionError(504, 'Error retrieving data from {}'.format(self.metrics_url),
+                                  endpoint='metrics', reason='status')
+        # Metrics are parsed one at a time while converting them below
+        metrics = lib.iter_metrics(content)
+
+        started = time.time()
+        status, content = info_response
+        if status >= 400:
+            raise CollectionError(504, 'Error retrieving data from {}'.format(self.info_url),
+                                  endpoint='info', reason='status')
+        try:
+            info = json.loads(content)['info']
+        except ValueError:
+            raise CollectionError(500, 'Error parsing info JSON data', endpoint='info', reason='parse')
+
+        status, content = cursors_response
+        # Some server modes we want to scrape do not support 'getcursors' command at all.
+        # These just respond with a 404 and the non-json informative unknown-commands output.
+        if status >= 400 and status != 404:
+            raise CollectionError(504, 'Error retrieving data from {}'.format(self.cursors_url),
+                                  endpoint='getcursor', reason='status')
+        cursors = None
+        if b"Supported HTTP commands" not in content:
+            try:
+                cursors = json.loads(content)['cursors']
+            except ValueError:
+                raise CollectionError(500, 'Error parsing cursor JSON data', endpoint='getcursor', reason='parse')
+        self.phase('decode', started)
+
+        # Labels and info metrics come from the same /info response
+        labels = self.get_labels(info)
+        registry = lib.Registry(default_labels=tuple(zip(self.label_names, labels)), layout=self.layout)
         ###########################################
         # Export metrics from the /metrics endpoint
         ###########################################
+        started = time.time()
         try:
-            response = requests.get(self.metrics_url)
-        except requests.ConnectionError:
-            self.error(504, 'Error retrieving data from {}'.format(self.metrics_url))
-            return
-        if not response.ok:
-            self.error(504, 'Error retrieving data from {}'.format(self.metrics_url))
-            return
-        try:
-            metrics = response.json()['metrics']
+            self.metrics_to_registry(registry, labels, metrics)
         except ValueError:
-            self.error(500, 'Error parsing metrics JSON data')
-            return
-        # iterate over all metrics
-        for k in metrics:
-            metric_name = re.sub(r'\.|-|\s', '_', k).lower()
-            metric_name = 'stellar_core_' + metric_name
-
-            if metrics[k]['type'] == 'timer':
-                # we have a timer, expose as a Prometheus Summary
-                # we convert stellar-core time units to seconds, as per Prometheus best practices
-                metric_name = metric_name + '_seconds'
-                if 'sum' in metrics[k]:
-                    # use libmedida sum value
-                    total_duration = metrics[k]['sum']
-                else:
-                    # compute sum value
-                    total_duration = (metrics[k]['mean'] * metrics[k]['count'])
-
-                self.registry.Summary(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                      count_value=metrics[k]['count'],
-                                      sum_value=lib.duration_to_seconds(total_duration, metrics[k]['duration_unit']),
-                                      )
-                # add stellar-core calculated quantiles to our summary
-                self.registry.Gauge(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                    labels=tuple(zip(self.label_names+['quantile'], self.labels+[0.75])),
-                                    value=lib.duration_to_seconds(metrics[k]['75%'], metrics[k]['duration_unit']),
-                                    )
-                self.registry.Gauge(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                    labels=tuple(zip(self.label_names+['quantile'], self.labels+[0.99])),
-                                    value=lib.duration_to_seconds(metrics[k]['99%'], metrics[k]['duration_unit']),
-                                    )
-                # Newer versions of core report a '100%' quantile which is the max
-                # sample over the recent sampling period (not all-time).
-                if '100%' in metrics[k]:
-                    self.registry.Gauge(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                        labels=tuple(zip(self.label_names+['quantile'], self.labels+[1.0])),
-                                        value=lib.duration_to_seconds(metrics[k]['100%'], metrics[k]['duration_unit']),
-                                        )
-
-            elif metrics[k]['type'] == 'histogram':
-                if 'count' not in metrics[k]:
-                    # Stellar-core version too old, we don't have required data
-                    continue
-
-                self.registry.Summary(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                      count_value=metrics[k]['count'],
-                                      sum_value=metrics[k]['sum'],
-                                      )
-                # add stellar-core calculated quantiles to our summary
-                self.registry.Gauge(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                    labels=tuple(zip(self.label_names+['quantile'], self.labels+[0.75])),
-                                    value=metrics[k]['75%'],
-                                    )
-                self.registry.Gauge(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                    labels=tuple(zip(self.label_names+['quantile'], self.labels+[0.99])),
-                                    value=metrics[k]['99%'],
-                                    )
-                # Newer versions of core report a '100%' quantile which is the max
-                # sample over the recent sampling period (not all-time).
-                if '100%' in metrics[k]:
-                    self.registry.Gauge(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                        labels=tuple(zip(self.label_names+['quantile'], self.labels+[1.0])),
-                                        value=metrics[k]['100%'],
-                                        )
-
-            elif metrics[k]['type'] == 'counter':
-                # we have a counter, this is a Prometheus Gauge
-                self.registry.Gauge(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                    value=metrics[k]['count']
-                                    )
-            elif metrics[k]['type'] == 'meter':
-                # we have a meter, this is a Prometheus Counter
-                self.registry.Counter(metric_name, 'libmedida metric type: ' + metrics[k]['type'],
-                                      value=metrics[k]['count']
-                                      )
-            elif metrics[k]['type'] == 'buckets':
-                # We have a bucket, this is a Prometheus Histogram
-                self.buckets_to_metrics(metric_name, metrics[k])
-
+            raise CollectionError(500, 'Error parsing metrics JSON data', endpoint='metrics', reason='parse')
+        self.phase('convert', started)
         #######################################
         # Export metrics from the info endpoint
         #######################################
+        self.info_to_registry(registry, labels, info)
+        #######################################
+        # Export cursor metrics
+        #######################################
+        if cursors is not None:
+            self.cursors_to_registry(registry, labels, cursors)
+
+        if not registry.sample_count():
+            raise CollectionError(500, 'Error - no metrics were genereated', reason='empty')
+        self.layout = registry.complete()
+        self.stats.set('stellar_core_exporter_samples', 'Samples exported by the last collection',
+                       registry.sample_count())
+        return registry
+
+    def exporter_metrics(self, registry, labels=()):
+        self.stats.to_registry(registry, labels)
+        registry.Counter('stellar_core_exporter_coalesced_scrapes_total',
+                         'Scrapes served the result of a collection started for another scrape',
+                         value=self.coalesced,
+                         labels=labels,
+                         )
+        registry.Counter('stellar_core_exporter_name_cache_hits_total',
+                         'Metric name translations served from cache',
+                         value=self.name_cache.hits,
+                         labels=labels,
+                         )
+        registry.Counter('stellar_core_exporter_name_cache_misses_total',
+                         'Metric name translations computed on cache miss',
+                         value=self.name_cache.misses,
+                         labels=labels,
+                         )
+
+    def response(self, future, url):
         try:
-            response = requests.get(self.info_url)
-        except requests.ConnectionError:
-            self.error(504, 'Error retrieving data from {}'.format(self.info_url))
-            return
-        if not response.ok:
-            self.error(504, 'Error retrieving data from {}'.format(self.info_url))
+            return future.result()
+        except socket.timeout:
+            raise CollectionError(504, 'Error retrieving data from {}'.format(url),
+                                  endpoint=self.endpoint_names[url], reason='timeout')
+        except (socket.error, HTTPException):
+            raise CollectionError(504, 'Error retrieving data from {}'.format(url),
+                                  endpoint=self.endpoint_names[url], reason='connection')
+
+    def response_sizes(self, raw, compressed=None):
+        # Records the size of a response before and after compression
+        self.stats.set('stellar_core_exporter_response_bytes', 'Size of the last response to a scraper',
+                       raw, (('encoding', 'identity'),))
+        if compressed is not None:
+            self.stats.set('stellar_core_exporter_response_bytes', 'Size of the last response to a scraper',
+                           compressed, (('encoding', 'gzip'),))
+
+    def scrape_started(self):
+        self.stats.add('stellar_core_exporter_scrapes_in_progress', 'Scrapes currently being served')
+
+    def scrape_finished(self):
+        self.stats.add('stellar_core_exporter_scrapes_in_progress', 'Scrapes currently being served', value=-1)
+
+    def translate(self, key):
+        # Returns Prometheus name, description, converter and whether derived metrics are exported of a core
+        # metric, results are cached. The converter is None for metrics which are not exported.
+        k, metric_type = key
+        metric_name = self.name_regex.sub('_', k).lower()
+        metric_name = 'stellar_core_' + metric_name
+        if metric_type == 'timer':
+            # we convert stellar-core time units to seconds, as per Prometheus best practices
+            metric_name = metric_name + '_seconds'
+        if self.metric_filter and not self.metric_filter(k, metric_name):
+            return metric_name, None, None, False
+        derive = bool(self.derived_filter and self.derived_filter(k, metric_name))
+        return metric_name, 'libmedida metric type: ' + metric_type, self.converters.get(metric_type), derive
+
+    def metrics_to_registry(self, registry, labels, metrics):
+        # metrics is an iterable of (core metric name, metric) pairs
+        quantile_labels = {q: tuple(zip(self.label_names+['quantile'], labels+[q])) for q in (0.75, 0.99, 1.0)}
+        # iterate over all metrics
+        if self.derived_window:
+            self.derived_window.begin(time.time())
+        for k, metric in metrics:
+            metric_name, description, convert, derive = self.name_cache.get((k, metric['type']))
+            if convert:
+                convert(registry, quantile_labels, metric_name, description, metric)
+                if derive:
+                    self.derive(registry, labels, metric_name, metric)
+
+    def derive(self, registry, labels, metric_name, metric):
+        # Exports the rate of a metric and, for metrics with a sum, the mean and bucket counts of observations
+        # since the base collection of the derived metrics window
+        metric_type = metric['type']
+        if 'count' not in metric and metric_type != 'buckets':
             return
-        try:
-            info = response.json()['info']
-        except ValueError:
-            self.error(500, 'Error parsing info JSON data')
+        bounds = []
+        if metric_type == 'buckets':
+            bounds, counts, count_value, sum_value = lib.bucket_counts(metric)
+            values = [count_value, sum_value] + counts
+        elif metric_type == 'timer':
+            total_duration = metric['sum'] if 'sum' in metric else metric['mean'] * metric['count']
+            values = [metric['count'], lib.duration_to_seconds(total_duration, metric['duration_unit'])]
+        elif metric_type == 'histogram':
+            values = [metric['count'], metric['sum']]
+        else:
+            values = [metric['count']]
+        changes = self.derived_window.change(metric_name, values)
+        elapsed = self.derived_window.elapsed
+        # libmedida counters may go down, other counts only do when core restarts. Derived metrics without
+        # a base collection are NaN rather than missing, so every collection exports the same series
+        if changes is None or elapsed <= 0 or (changes[0] < 0 and metric_type != 'counter'):
+            changes = [NAN] * len(values)
+            elapsed = 1
+
+        rate, mean, window_bucket = self.derived_names.get(metric_name)
+        registry.Gauge(rate[0], rate[1], value=changes[0] / elapsed)
+        if len(changes) > 1:
+            # NaN without observations in the window
+            registry.Gauge(mean[0], mean[1], value=changes[1] / changes[0] if changes[0] > 0 else NAN)
+        for bound, change in zip(bounds, changes[2:]):
+            registry.Gauge(window_bucket[0], window_bucket[1],
+                           value=change,
+                           labels=tuple(zip(self.label_names+['le'], labels+[str(bound)])),
+                           )
+
+    @staticmethod
+    def derived_translate(metric_name):
+        # Returns names and descriptions of the derived metrics of metric_name
+        return ((metric_name + '_rate',
+                 'Per second rate of {} over the exporter derived metrics window'.format(metric_name)),
+                (metric_name + '_mean',
+                 'Mean of {} observations over the exporter derived metrics window'.format(metric_name)),
+                (metric_name + '_window_bucket',
+                 'Cumulative buckets of {} observations in the exporter derived metrics window'.format(metric_name)))
+
+    def timer_to_metrics(self, registry, quantile_labels, metric_name, description, metric):
+        # we have a timer, expose as a Prometheus Summary
+        unit = metric['duration_unit']
+        if 'sum' in metric:
+            # use libmedida sum value
+            total_duration = metric['sum']
+        else:
+            # compute sum value
+            total_duration = (metric['mean'] * metric['count'])
+
+        registry.Summary(metric_name, description,
+                         count_value=metric['count'],
+                         sum_value=lib.duration_to_seconds(total_duration, unit),
+                         )
+        # add stellar-core calculated quantiles to our summary
+        registry.Quantile(metric_name, description,
+                          labels=quantile_labels[0.75],
+                          value=lib.duration_to_seconds(metric['75%'], unit),
+                          )
+        registry.Quantile(metric_name, description,
+                          labels=quantile_labels[0.99],
+                          value=lib.duration_to_seconds(metric['99%'], unit),
+                          )
+        # Newer versions of core report a '100%' quantile which is the max
+        # sample over the recent sampling period (not all-time).
+        if '100%' in metric:
+            registry.Quantile(metric_name, description,
+                              labels=quantile_labels[1.0],
+                              value=lib.duration_to_seconds(metric['100%'], unit),
+                              )
+
+    def histogram_to_metrics(self, registry, quantile_labels, metric_name, description, metric):
+        if 'count' not in metric:
+            # Stellar-core version too old, we don't have required data
             return
+
+        registry.Summary(metric_name, description,
+                         count_value=metric['count'],
+                         sum_value=metric['sum'],
+                         )
+        # add stellar-core calculated quantiles to our summary
+        registry.Quantile(metric_name, description,
+                          labels=quantile_labels[0.75],
+                          value=metric['75%'],
+                          )
+        registry.Quantile(metric_name, description,
+                          labels=quantile_labels[0.99],
+                          value=metric['99%'],
+                          )
+        # Newer versions of core report a '100%' quantile which is the max
+        # sample over the recent sampling period (not all-time).
+        if '100%' in metric:
+            registry.Quantile(metric_name, description,
+                              labels=quantile_labels[1.0],
+                              value=metric['100%'],
+                              )
+
+    def counter_to_metrics(self, registry, quantile_labels, metric_name, description, metric):
+        # we have a counter, this is a Prometheus Gauge
+        registry.Gauge(metric_name, description,
+                       value=metric['count']
+                       )
+
+    def meter_to_metrics(self, registry, quantile_labels, metric_name, description, metric):
+        # we have a meter, this is a Prometheus Counter
+        registry.Counter(metric_name, description,
+                         value=metric['count']
+                         )
+
+    def info_to_registry(self, registry, labels, info):
         if not all([i in info for i in self.info_keys]):
-            self.error(500, 'Error - info endpoint did not return all required fields')
-            return
+            raise CollectionError(500, 'Error - info endpoint did not return all required fields',
+                                  endpoint='info', reason='data')
 
         # Ledger metrics
         for core_name, prom_name in self.ledger_metrics.items():
-            self.registry.Gauge('stellar_core_ledger_{}'.format(prom_name),
-                                'Stellar core ledger metric name: {}'.format(core_name),
-                                value=info['ledger'][core_name],
-                                )
+            registry.Gauge('stellar_core_ledger_{}'.format(prom_name),
+                           'Stellar core ledger metric name: {}'.format(core_name),
+                           value=info['ledger'][core_name],
+                           )
         # Version 11.2.0 and later report quorum metrics in the following format:
         # "quorum" : {
         #    "qset" : {
@@ -264,18 +591,17 @@ class StellarCoreHandler(BaseHTTPRequestHandler):
         if 'qset' in info['quorum']:
             tmp = info['quorum']['qset']
         else:
-            tmp = info['quorum'].values()[0]
+            tmp = list(info['quorum'].values())[0]
         if not tmp:
-            self.error(500, 'Error - missing quorum data')
-            return
+            raise CollectionError(500, 'Error - missing quorum data', endpoint='info', reason='data')
 
         for metric in self.quorum_metrics:
             try:
 
-                self.registry.Gauge('stellar_core_quorum_{}'.format(metric),
-                                    'Stellar core quorum metric: {}'.format(metric),
-                                    tmp[metric]
-                                    )
+                registry.Gauge('stellar_core_quorum_{}'.format(metric),
+                               'Stellar core quorum metric: {}'.format(metric),
+                               tmp[metric]
+                               )
             except KeyError as e:
                 self.log_message('Unable to find metric in quorum qset: {}. This is probably fine and will fix itself as stellar-core joins the quorum, or core is running cli catchup'.format(metric))
 
@@ -286,10 +612,10 @@ class StellarCoreHandler(BaseHTTPRequestHandler):
                     value = 1
                 else:
                     value = 0
-                self.registry.Gauge('stellar_core_quorum_phase_{}'.format(metric),
-                                    'Stellar core quorum phase {}'.format(metric),
-                                    value=value,
-                                    )
+                registry.Gauge('stellar_core_quorum_phase_{}'.format(metric),
+                               'Stellar core quorum phase {}'.format(metric),
+                               value=value,
+                               )
         except KeyError as e:
                 self.log_message('Unable to find phase in quorum qset. This is probably fine and will fix itself as stellar-core joins the quorum, or core is running cli catchup')
 
@@ -299,110 +625,482 @@ class StellarCoreHandler(BaseHTTPRequestHandler):
                 value = 1
             else:
                 value = 0
-            self.registry.Gauge('stellar_core_quorum_transitive_intersection',
-                                'Stellar core quorum transitive intersection',
-                                value=value,
-                                )
-            self.registry.Gauge('stellar_core_quorum_transitive_last_check_ledger',
-                                'Stellar core quorum transitive last_check_ledger',
-                                value=info['quorum']['transitive']['last_check_ledger'],
-                                )
-            self.registry.Gauge('stellar_core_quorum_transitive_node_count',
-                                'Stellar core quorum transitive node_count',
-                                value=info['quorum']['transitive']['node_count'],
-                                )
+            registry.Gauge('stellar_core_quorum_transitive_intersection',
+                           'Stellar core quorum transitive intersection',
+                           value=value,
+                           )
+            registry.Gauge('stellar_core_quorum_transitive_last_check_ledger',
+                           'Stellar core quorum transitive last_check_ledger',
+                           value=info['quorum']['transitive']['last_check_ledger'],
+                           )
+            registry.Gauge('stellar_core_quorum_transitive_node_count',
+                           'Stellar core quorum transitive node_count',
+                           value=info['quorum']['transitive']['node_count'],
+                           )
             # Versions >=11.3.0 expose "critical" key
             if 'critical' in info['quorum']['transitive']:
                 if info['quorum']['transitive']['critical']:
-                    for peer_list in info['quorum']['transitive']['critical']:
-                        critical_peers = ','.join(sorted(peer_list))  # label value is comma separated listof peers
-                        self.registry.Gauge('stellar_core_quorum_transitive_critical',
-                                            'Stellar core quorum transitive critical',
-                                            labels=tuple(zip(self.label_names+['critical_validators'],
-                                                             self.labels+[critical_peers])),
-                                            value=1,
-                                            )
+                    # label value is comma separated listof peers
+                    groups = [','.join(sorted(peer_list)) for peer_list in info['quorum']['transitive']['critical']]
+                    groups, overflow = self.limit_series(self.critical_limit, 'stellar_core_quorum_transitive_critical',
+                                                         groups)
+                    for critical_peers in groups:
+                        registry.Gauge('stellar_core_quorum_transitive_critical',
+                                       'Stellar core quorum transitive critical',
+                                       labels=tuple(zip(self.label_names+['critical_validators'],
+                                                        labels+[critical_peers])),
+                                       value=1,
+                                       )
+                    if overflow:
+                        # Number of aggregated groups
+                        registry.Gauge('stellar_core_quorum_transitive_critical',
+                                       'Stellar core quorum transitive critical',
+                                       labels=tuple(zip(self.label_names+['critical_validators'],
+                                                        labels+[lib.OVERFLOW_LABEL])),
+                                       value=len(overflow),
+                                       )
                 else:
-                    self.registry.Gauge('stellar_core_quorum_transitive_critical',
-                                        'Stellar core quorum transitive critical',
-                                        labels=tuple(zip(self.label_names+['critical_validators'], self.labels+['null'])),
-                                        value=0,
-                                        )
+                    registry.Gauge('stellar_core_quorum_transitive_critical',
+                                   'Stellar core quorum transitive critical',
+                                   labels=tuple(zip(self.label_names+['critical_validators'], labels+['null'])),
+                                   value=0,
+                                   )
         # Peers metrics
-        self.registry.Gauge('stellar_core_peers_authenticated_count',
-                            'Stellar core authenticated_count count',
-                            value=info['peers']['authenticated_count'],
-                            )
-
-        self.registry.Gauge('stellar_core_peers_pending_count',
-                            'Stellar core pending_count count',
-                            value=info['peers']['pending_count'],
-                            )
-        self.registry.Gauge('stellar_core_protocol_version',
-                            'Stellar core protocol_version',
-                            value=info['protocol_version'],
-                            )
+        registry.Gauge('stellar_core_peers_authenticated_count',
+                       'Stellar core authenticated_count count',
+                       value=info['peers']['authenticated_count'],
+                       )
+
+        registry.Gauge('stellar_core_peers_pending_count',
+                       'Stellar core pending_count count',
+                       value=info['peers']['pending_count'],
+                       )
+        registry.Gauge('stellar_core_protocol_version',
+                       'Stellar core protocol_version',
+                       value=info['protocol_version'],
+                       )
         for metric in self.state_metrics:
             name = re.sub(r'\s', '_', metric)
             if info['state'].lower().startswith(metric):  # Use startswith to work around "!"
                 value = 1
             else:
                 value = 0
-            self.registry.Gauge('stellar_core_{}'.format(name),
-                                'Stellar core state {}'.format(metric),
-                                value=value,
-                                )
+            registry.Gauge('stellar_core_{}'.format(name),
+                           'Stellar core state {}'.format(metric),
+                           value=value,
+                           )
         date = datetime.strptime(info['startedOn'], "%Y-%m-%dT%H:%M:%SZ")
-        self.registry.Gauge('stellar_core_started_on', 'Stellar core start time in epoch',
-                            value=int(date.strftime('%s')),
-                            )
-        #######################################
-        # Export cursor metrics
-        #######################################
+        registry.Gauge('stellar_core_started_on', 'Stellar core start time in epoch',
+                       value=int(date.strftime('%s')),
+                       )
+
+    def cursors_to_registry(self, registry, labels, cursors):
+        cursors = [(cursor.get('id').strip(), cursor['cursor']) for cursor in cursors if cursor]
+        kept, overflow = self.limit_series(self.cursor_limit, 'stellar_core_active_cursors',
+                                           [cursor_name for cursor_name, _ in cursors])
+        kept = set(kept)
+        for cursor_name, value in cursors:
+            if cursor_name not in kept:
+                continue
+            registry.Gauge('stellar_core_active_cursors',
+                           'Stellar core active cursors',
+                           labels=tuple(zip(self.label_names+['cursor_name'], labels+[cursor_name])),
+                           value=value,
+                           )
+        if overflow:
+            # The oldest of the aggregated cursors, it holds back history like any other
+            registry.Gauge('stellar_core_active_cursors',
+                           'Stellar core active cursors',
+                           labels=tuple(zip(self.label_names+['cursor_name'], labels+[lib.OVERFLOW_LABEL])),
+                           value=min(value for cursor_name, value in cursors if cursor_name not in kept),
+                           )
+
+    def limit_series(self, limit, name, values):
+        # Returns the label values of metric name exported as their own series and the ones to aggregate
+        kept, overflow = limit.split(values)
+        labels = (('metric', name),)
+        self.stats.set('stellar_core_exporter_overflow_series',
+                       'Label values of a metric aggregated into its __overflow__ series by the last collection',
+                       len(overflow), labels)
+        self.stats.set('stellar_core_exporter_tracked_series',
+                       'Label values of a metric holding one of its limited series',
+                       len(limit.seen), labels)
+        self.stats.inc('stellar_core_exporter_stale_series_total',
+                       'Label values of a metric whose series was released after not being seen',
+                       labels, limit.expired)
+        return kept, overflow
+
+
+class Poller(object):
+    """Collects metrics in a background thread and keeps the latest rendered snapshot.
+
+    Scrapes are served from the snapshot so their latency does not depend on core
+    and the load on core does not depend on the number of scrapers.
+    """
+    def __init__(self, collector, interval, gzip_level=6):
+        self.collector = collector
+        self.interval = interval
+        self.gzip_level = gzip_level
+        self.lock = threading.Lock()
+        self.registry = None
+        self.timestamp = None
+        self.error = CollectionError(503, 'Error - no metrics were collected yet')
+
+    def poll(self):
         try:
-            response = requests.get(self.cursors_url)
-        except requests.ConnectionError:
-            self.error(504, 'Error retrieving data from {}'.format(self.cursors_url))
+            registry = self.collector.collect()
+            started = time.time()
+            # Other formats are rendered on first request
+            registry.output(self.gzip_level)
+            self.collector.phase('render', started)
+        except CollectionError as e:
+            error = e
+        except Exception as e:
+            error = CollectionError(500, 'Error collecting metrics: {}'.format(e))
+        else:
+            with self.lock:
+                self.registry = registry
+                self.timestamp = time.time()
+                self.error = None
             return
+        with self.lock:
+            self.error = error
 
-        # Some server modes we want to scrape do not support 'getcursors' command at all.
-        # These just respond with a 404 and the non-json informative unknown-commands output.
-        if not response.ok and response.status_code != 404:
-            self.error(504, 'Error retrieving data from {}'.format(self.cursors_url))
-            return
+    def run(self):
+        while True:
+            started = time.time()
+            self.poll()
+            time.sleep(max(0, self.interval - (time.time() - started)))
 
-        if "Supported HTTP commands" not in str(response.content):
-            try:
-                cursors = response.json()['cursors']
-            except ValueError:
-                self.error(500, 'Error parsing cursor JSON data')
-                return
-
-            for cursor in cursors:
-                if not cursor:
-                    continue
-                cursor_name = cursor.get('id').strip()
-                self.registry.Gauge('stellar_core_active_cursors',
-                                    'Stellar core active cursors',
-                                    labels=tuple(zip(self.label_names+['cursor_name'], self.labels+[cursor_name])),
-                                    value=cursor['cursor'],
-                                    )
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
 
-        #######################################
-        # Render output
-        #######################################
-        output = self.registry.render()
-        if not output:
-            self.error(500, 'Error - no metrics were genereated')
-            return
-        self.send_response(200)
+    def snapshot(self):
+        """Returns the lib.Registry of the latest snapshot.
+
+        Once a snapshot exists it keeps being served when later polls fail, the growing
+        stellar_core_exporter_snapshot_age_seconds tells Prometheus that the data is stale.
+        """
+        with self.lock:
+            if self.registry is None:
+                raise self.error
+            return self.registry
+
+    def exporter_metrics(self, registry, labels=()):
+        with self.lock:
+            timestamp = self.timestamp
+        if timestamp is not None:
+            registry.Gauge('stellar_core_exporter_snapshot_age_seconds',
+                           'Seconds since the served snapshot was collected from stellar-core',
+                           value=time.time() - timestamp,
+                           labels=labels,
+                           )
+        self.collector.exporter_metrics(registry, labels)
+
+
+class StellarCoreHandler(BaseHTTPRequestHandler):
+    content_type = str(lib.CONTENT_TYPES[lib.TEXT])
+
+    def log_message(self, format, *args):
+        return
+
+    def error(self, code, msg):
+        self.send_response(code)
         self.send_header('Content-Type', self.content_type)
         self.end_headers()
-        self.wfile.write(output)
+        self.wfile.write('{}\n'.format(msg).encode('utf-8'))
 
+    def do_GET(self):
+        if urlparse(self.path).path == '/exporter-metrics':
+            output = exporter_metrics(self.server.targets)
+            self.send_response(200)
+            self.send_header('Content-Type', self.content_type)
+            self.end_headers()
+            self.wfile.write(output)
+            return
+        try:
+            collector, poller = find_target(self.server.targets, self.path)
+        except CollectionError as e:
+            self.error(e.code, e.msg)
+            return
+        collector.scrape_started()
+        try:
+            self.scrape(collector, poller)
+        finally:
+            collector.scrape_finished()
+
+    def scrape(self, collector, poller):
+        try:
+            if poller:
+                registry = poller.snapshot()
+            else:
+                registry = collector.collect()
+        except CollectionError as e:
+            self.error(e.code, e.msg)
+            return
+        fmt = lib.negotiate(self.headers.get('Accept'), self.server.openmetrics)
+        native_schema = self.server.native_histogram_schema
+        tail = scrape_tail(poller or collector, fmt, native_schema)
+
+        compress = self.server.gzip_level and accepts_gzip(self.headers.get('Accept-Encoding'))
+        self.send_response(200)
+        self.send_header('Content-Type', lib.CONTENT_TYPES[fmt])
+        started = time.time()
+        if compress:
+            output = registry.output(self.server.gzip_level, fmt, native_schema)
+            body = output.gzip(tail)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            collector.response_sizes(len(output.data) + len(tail), len(body))
+        elif poller:
+            output = registry.output(self.server.gzip_level, fmt, native_schema)
+            self.send_header('Content-Length', str(len(output.data) + len(tail)))
+            self.end_headers()
+            self.wfile.write(output.data + tail)
+            collector.response_sizes(len(output.data) + len(tail))
+        else:
+            # Rendering is streamed, the write phase includes it
+            self.end_headers()
+            size = registry.write(self.wfile, fmt, native_schema)
+            self.wfile.write(tail)
+            collector.response_sizes(size + len(tail))
+        collector.phase('write', started)
+
+
+def scrape_tail(source, fmt, native_schema=None):
+    # Returns the self-metrics of source, a Collector or Poller, which end a scrape response in format fmt
+    registry = lib.Registry(default_labels=())
+    source.exporter_metrics(registry)
+    tail = registry.render(fmt, native_schema)
+    if fmt == lib.OPENMETRICS:
+        tail += lib.OPENMETRICS_EOF
+    return tail
+
+
+def accepts_gzip(accept_encoding):
+    # Returns whether an Accept-Encoding header value allows gzip
+    for coding in (accept_encoding or '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() != 'gzip':
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def exporter_metrics(targets):
+    # Returns self-metrics of all targets labeled with the target name, empty for the default target
+    registry = lib.Registry(default_labels=())
+    for name, (collector, poller) in sorted(targets.items(), key=lambda t: t[0] or ''):
+        (poller or collector).exporter_metrics(registry, (('target', name or ''),))
+    return registry.render()
+
+
+def find_target(targets, path):
+    # Returns the targets entry for the request path, /probe?target=NAME or the default target
+    url = urlparse(path)
+    if url.path != '/probe':
+        if None not in targets:
+            raise CollectionError(404, 'Error - metrics are served on /probe?target=NAME')
+        return targets[None]
+    name = parse_qs(url.query).get('target', [None])[0]
+    if not name:
+        raise CollectionError(400, 'Error - missing target parameter')
+    if name not in targets:
+        raise CollectionError(404, 'Error - unknown target {}'.format(name))
+    return targets[name]
+
+
+def load_targets(path):
+    # Target file is a JSON object mapping target names to stellar-core addresses
+    with open(path) as f:
+        targets = json.load(f)
+    if not isinstance(targets, dict):
+        raise ValueError('{} must contain a JSON object of target names and addresses'.format(path))
+    return targets
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='simple stellar-core Prometheus exporter/scraper')
+    parser.add_argument('--stellar-core-address', type=str,
+                        help='Stellar core address. Defaults to STELLAR_CORE_ADDRESS environment '
+                             'variable or if not set to http://127.0.0.1:11626',
+                        default=environ.get('STELLAR_CORE_ADDRESS', 'http://127.0.0.1:11626'))
+    parser.add_argument('--port', type=int,
+                        help='HTTP bind port. Defaults to PORT environment variable '
+                             'or if not set to 9473',
+                        default=int(environ.get('PORT', '9473')))
+    parser.add_argument('--poll-interval', type=float,
+                        help='Poll stellar-core in the background every POLL_INTERVAL seconds and serve '
+                             'the latest snapshot on scrape. Defaults to POLL_INTERVAL environment variable '
+                             'or if not set to 0, which collects metrics on every scrape',
+                        default=float(environ.get('POLL_INTERVAL', '0')))
+    parser.add_argument('--metrics-timeout', type=float,
+                        help='Timeout in seconds for the stellar-core /metrics request. Defaults to METRICS_TIMEOUT '
+                             'environment variable or if not set to 10',
+                        default=float(environ.get('METRICS_TIMEOUT', '10')))
+    parser.add_argument('--info-timeout', type=float,
+                        help='Timeout in seconds for the stellar-core /info request. Defaults to INFO_TIMEOUT '
+                             'environment variable or if not set to 5',
+                        default=float(environ.get('INFO_TIMEOUT', '5')))
+    parser.add_argument('--cursors-timeout', type=float,
+                        help='Timeout in seconds for the stellar-core /getcursor request. Defaults to CURSORS_TIMEOUT '
+                             'environment variable or if not set to 5',
+                        default=float(environ.get('CURSORS_TIMEOUT', '5')))
+    parser.add_argument('--targets-file', type=str,
+                        help='JSON file mapping target names to stellar-core addresses, each target is served '
+                             'on /probe?target=NAME instead of --stellar-core-address on any path. Defaults to '
+                             'TARGETS_FILE environment variable',
+                        default=environ.get('TARGETS_FILE'))
+    parser.add_argument('--min-collect-interval', type=float,
+                        help='Serve the previous collection of a target to scrapes arriving less than '
+                             'MIN_COLLECT_INTERVAL seconds after it finished. Defaults to MIN_COLLECT_INTERVAL '
+                             'environment variable or if not set to 0',
+                        default=float(environ.get('MIN_COLLECT_INTERVAL', '0')))
+    parser.add_argument('--max-upstream-requests', type=int,
+                        help='Maximum number of in-flight requests to all stellar-cores. Defaults to '
+                             'MAX_UPSTREAM_REQUESTS environment variable or if not set to 16',
+                        default=int(environ.get('MAX_UPSTREAM_REQUESTS', '16')))
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Serve scrapes from an asyncio event loop with non-blocking requests to stellar-core, '
+                             'concurrent scrapes of a target share one collection. Defaults to ASYNCIO environment '
+                             'variable being set to 1',
+                        default=environ.get('ASYNCIO') == '1')
+    parser.add_argument('--include-metrics', type=str,
+                        help='Comma separated regular expressions, only stellar-core metrics whose raw name, '
+                             'e.g. ledger.ledger.close, fully matches one of them are exported. Defaults to '
+                             'INCLUDE_METRICS environment variable',
+                        default=environ.get('INCLUDE_METRICS'))
+    parser.add_argument('--exclude-metrics', type=str,
+                        help='Comma separated regular expressions, stellar-core metrics whose raw name fully '
+                             'matches one of them are not exported. Defaults to EXCLUDE_METRICS environment variable',
+                        default=environ.get('EXCLUDE_METRICS'))
+    parser.add_argument('--metrics-preset', type=str, choices=sorted(PRESETS),
+                        help='Also export stellar-core metrics used by the shipped Grafana dashboard, other metrics '
+                             'are not exported unless included by --include-metrics. Defaults to METRICS_PRESET '
+                             'environment variable',
+                        default=environ.get('METRICS_PRESET'))
+    parser.add_argument('--workers', type=int,
+                        help='Serve scrapes from WORKERS processes reading snapshots of --poll-interval from shared '
+                             'memory, the main process only collects and renders. Defaults to WORKERS environment '
+                             'variable or if not set to 0, which serves scrapes from the main process',
+                        default=int(environ.get('WORKERS', '0')))
+    parser.add_argument('--shared-buffer-size', type=int,
+                        help='Size in MiB of each of the two shared memory buffers of a target with --workers, '
+                             'they must hold a snapshot in all requested formats. Defaults to SHARED_BUFFER_SIZE '
+                             'environment variable or if not set to 64',
+                        default=int(environ.get('SHARED_BUFFER_SIZE', '64')))
+    parser.add_argument('--max-cursor-series', type=int,
+                        help='Maximum number of stellar_core_active_cursors series per target, further cursors are '
+                             'aggregated into one series. 0 disables the limit. Defaults to MAX_CURSOR_SERIES '
+                             'environment variable or if not set to 100',
+                        default=int(environ.get('MAX_CURSOR_SERIES', '100')))
+    parser.add_argument('--max-critical-series', type=int,
+                        help='Maximum number of stellar_core_quorum_transitive_critical series per target, further '
+                             'critical validator groups are aggregated into one series. 0 disables the limit. '
+                             'Defaults to MAX_CRITICAL_SERIES environment variable or if not set to 20',
+                        default=int(environ.get('MAX_CRITICAL_SERIES', '20')))
+    parser.add_argument('--derived-metrics', type=str,
+                        help='Comma separated regular expressions, stellar-core metrics whose raw name fully matches '
+                             'one of them are also exported as per second rates and, for timers, histograms and '
+                             'buckets, mean and bucket counts of recent observations. Defaults to DERIVED_METRICS '
+                             'environment variable',
+                        default=environ.get('DERIVED_METRICS'))
+    parser.add_argument('--derived-window', type=float,
+                        help='Window in seconds of derived metrics. Defaults to DERIVED_WINDOW environment variable '
+                             'or if not set to 60',
+                        default=float(environ.get('DERIVED_WINDOW', '60')))
+    parser.add_argument('--gzip-level', type=int, choices=range(10), metavar='0-9',
+                        help='gzip compression level of responses to scrapers accepting it, 0 disables compression. '
+                             'Defaults to GZIP_LEVEL environment variable or if not set to 6',
+                        default=int(environ.get('GZIP_LEVEL', '6')))
+    parser.add_argument('--native-histogram-schema', type=int, choices=range(-4, 9), metavar='-4-8',
+                        help='Add native histograms with this schema to histograms served in the protobuf format. '
+                             'Defaults to NATIVE_HISTOGRAM_SCHEMA environment variable',
+                        default=environ.get('NATIVE_HISTOGRAM_SCHEMA') and int(environ['NATIVE_HISTOGRAM_SCHEMA']))
+    parser.add_argument('--openmetrics', action='store_true',
+                        help='Serve the OpenMetrics format to scrapers preferring it, which Prometheus does by '
+                             'default. Counters not ending in _total, like all stellar-core meters, are unknown '
+                             'metrics in this format. Defaults to OPENMETRICS environment variable being set to 1',
+                        default=environ.get('OPENMETRICS') == '1')
+    args = parser.parse_args(argv)
+    if args.workers and args.poll_interval <= 0:
+        parser.error('--workers requires --poll-interval')
+    if args.workers and args.asyncio:
+        parser.error('--workers and --asyncio can not be combined')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The default target, served on any path other than /probe, is keyed by None. With a targets file
+    # only its targets are collected
+    if args.targets_file:
+        addresses = load_targets(args.targets_file)
+    else:
+        addresses = {None: args.stellar_core_address}
+    upstream_limit = threading.BoundedSemaphore(args.max_upstream_requests)
+    metric_filter = None
+    if args.include_metrics or args.exclude_metrics or args.metrics_preset:
+        metric_filter = lib.MetricFilter(include=args.include_metrics and args.include_metrics.split(','),
+                                         exclude=args.exclude_metrics and args.exclude_metrics.split(','),
+                                         names=args.metrics_preset and PRESETS[args.metrics_preset],
+                                         )
+
+    derived_filter = None
+    if args.derived_metrics:
+        derived_filter = lib.MetricFilter(include=args.derived_metrics.split(','))
+
+    targets = {}
+    for name, address in addresses.items():
+        collector = Collector(address,
+                              metrics_timeout=args.metrics_timeout,
+                              info_timeout=args.info_timeout,
+                              cursors_timeout=args.cursors_timeout,
+                              upstream_limit=upstream_limit,
+                              min_interval=args.min_collect_interval,
+                              metric_filter=metric_filter,
+                              max_cursor_series=args.max_cursor_series,
+                              max_critical_series=args.max_critical_series,
+                              derived_filter=derived_filter,
+                              derived_window=args.derived_window,
+                              )
+        poller = None
+        if args.poll_interval > 0:
+            poller = Poller(collector, args.poll_interval, gzip_level=args.gzip_level)
+        targets[name] = (collector, poller)
+
+    if args.workers:
+        from . import shm
+        # Workers are forked before pollers start their threads
+        shm.serve(args.port, targets, args.workers, args.gzip_level, args.native_histogram_schema,
+                  args.shared_buffer_size * 2**20, args.openmetrics)
+        return
+    for collector, poller in targets.values():
+        if poller:
+            poller.start()
+
+    if args.asyncio:
+        from . import aio
+        aio.serve(args.port, targets, args.max_upstream_requests, args.gzip_level, args.native_histogram_schema,
+                  args.openmetrics)
+        return
 
-def main():
     httpd = _ThreadingSimpleServer(("", args.port), StellarCoreHandler)
+    httpd.targets = targets
+    httpd.gzip_level = args.gzip_level
+    httpd.native_histogram_schema = args.native_histogram_schema
+    httpd.openmetrics = args.openmetrics
     t = threading.Thread(target=httpd.serve_forever)
     t.daemon = True
     t.start()
@@ -411,4 +1109,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    # Run the package module rather than this __main__ copy of it, modules imported by it like aio and shm
+    # must share its classes, e.g. to catch CollectionError
+    from stellar_core_prometheus_exporter import exporter
+    exporter.main()
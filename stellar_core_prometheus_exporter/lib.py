@@ -1,56 +1,777 @@
 #!/usr/bin/python
 # vim: tabstop=4 expandtab shiftwidth=4
 
+import io
+import json
+import math
+import re
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from operator import itemgetter
+
+from . import protobuf
+
+# Imported by load_ijson on first use, it takes longer to import than the exporter. False if not installed.
+ijson = None
+
+
+# stellar-core duration unit -> (multiplier, divisor) converting it to seconds
+TIME_UNITS_TO_SECONDS = {
+    'd':  (86400.0, 1.0),
+    'h':  (3600.0, 1.0),
+    'm':  (60.0, 1.0),
+    's':  (1.0, 1.0),
+    'ms': (1.0, 1000.0),
+    'us': (1.0, 1000000.0),
+    'ns': (1.0, 1000000000.0),
+}
+
 
 def duration_to_seconds(duration, duration_unit):
     # given duration and duration_unit, returns duration in seconds
-    time_units_to_seconds = {
-        'd':  'duration * 86400.0',
-        'h':  'duration * 3600.0',
-        'm':  'duration * 60.0',
-        's':  'duration / 1.0',
-        'ms': 'duration / 1000.0',
-        'us': 'duration / 1000000.0',
-        'ns': 'duration / 1000000000.0',
-    }
-    return eval(time_units_to_seconds[duration_unit])
+    multiplier, divisor = TIME_UNITS_TO_SECONDS[duration_unit]
+    return duration * multiplier / divisor
+
+
+def bucket_counts(metric):
+    """Returns cumulative buckets of a stellar-core buckets metric.
+
+    Returns upper bounds in seconds, ending with '+Inf', the cumulative count of each bound, the total count
+    and the total sum in seconds. Buckets larger than 30 days are treated as infinity.
+    """
+    # Same arithmetic as duration_to_seconds, without a lookup per value
+    multiplier, divisor = TIME_UNITS_TO_SECONDS[metric['boundary_unit']]
+    bounds = []
+    counts = []
+    count_value = 0
+    sum_value = 0
+    for bucket in sorted(metric['buckets'], key=itemgetter('boundary')):
+        # Buckets from core contain only values from their respective ranges.
+        # Prometheus expects "le" buckets to be cummulative so we need some extra math
+        count_value += bucket['count']
+        sum_value += bucket['sum'] * multiplier / divisor
+        boundary = bucket['boundary'] * multiplier / divisor
+        if boundary > 30 * 86400:
+            continue
+        bounds.append(boundary)
+        counts.append(count_value)
+    # Histograms need a +Inf bucket, it holds all values
+    bounds.append('+Inf')
+    counts.append(count_value)
+    return bounds, counts, count_value, sum_value
+
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def skip_json(text, idx, expected=None):
+    # returns index of the next non-whitespace character, which must be expected if given
+    idx = JSON_WHITESPACE.match(text, idx).end()
+    if expected is None:
+        return idx
+    if not text.startswith(expected, idx):
+        raise ValueError('Expecting {!r} at char {}'.format(expected, idx))
+    return idx + 1
+
+
+def load_ijson():
+    global ijson
+    if ijson is None:
+        try:
+            import ijson as module
+        except ImportError:
+            module = False
+        ijson = module
+    return ijson
+
+
+def iter_metrics(content):
+    """Yields (name, metric) pairs of a stellar-core /metrics document one metric at a time.
+
+    Only a single metric is materialized at once instead of the whole document. Uses ijson
+    when it is installed. Raises ValueError on malformed documents and documents without a
+    top level "metrics" object, possibly after yielding some metrics.
+    """
+    if load_ijson():
+        found = False
+        try:
+            for item in ijson.kvitems(io.BytesIO(content), 'metrics', use_float=True):
+                found = True
+                yield item
+        except ijson.JSONError as e:
+            raise ValueError(str(e))
+        if not found:
+            # kvitems yields nothing as well without a "metrics" object, let the parser below tell
+            for item in iter_metrics_json(content):
+                yield item
+        return
+
+    for item in iter_metrics_json(content):
+        yield item
+
+
+def iter_metrics_json(content):
+    # iter_metrics with the json module
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    decoder = json.JSONDecoder()
+    try:
+        # Find the "metrics" member of the top level object, skipping any others
+        idx = skip_json(content, 0, '{')
+        while True:
+            if content.startswith('}', skip_json(content, idx)):
+                raise ValueError('No "metrics" object in metrics JSON data')
+            key, idx = decoder.raw_decode(content, skip_json(content, idx))
+            idx = skip_json(content, idx, ':')
+            if key == 'metrics':
+                break
+            _, idx = decoder.raw_decode(content, skip_json(content, idx))
+            idx = skip_json(content, idx)
+            if not content.startswith('}', idx):
+                idx = skip_json(content, idx, ',')
+
+        idx = skip_json(content, idx, '{')
+        if content.startswith('}', skip_json(content, idx)):
+            idx = skip_json(content, idx) + 1
+        else:
+            while True:
+                name, idx = decoder.raw_decode(content, skip_json(content, idx))
+                idx = skip_json(content, idx, ':')
+                metric, idx = decoder.raw_decode(content, skip_json(content, idx))
+                yield name, metric
+                idx = skip_json(content, idx)
+                if content.startswith('}', idx):
+                    idx += 1
+                    break
+                idx = skip_json(content, idx, ',')
+
+        # Skip members after "metrics", the top level object must be complete
+        while not content.startswith('}', skip_json(content, idx)):
+            idx = skip_json(content, idx, ',')
+            _, idx = decoder.raw_decode(content, skip_json(content, idx))
+            idx = skip_json(content, idx, ':')
+            _, idx = decoder.raw_decode(content, skip_json(content, idx))
+        idx = skip_json(content, idx, '}')
+        if skip_json(content, idx) != len(content):
+            raise ValueError('Extra data at char {}'.format(skip_json(content, idx)))
+    except IndexError:
+        raise ValueError('Unexpected end of metrics JSON data')
+
+
+class LRUCache(object):
+    """Thread safe mapping of at most size keys to translate(key), least recently used keys are evicted."""
+    def __init__(self, translate, size):
+        self.translate = translate
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+        value = self.translate(key)
+        with self.lock:
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+
+class MetricFilter(object):
+    """Decides which stellar-core metrics are exported.
+
+    include and exclude are lists of regular expressions which must match the whole raw core
+    metric name, e.g. 'overlay\\..*'. Metrics must match an include pattern or have one of
+    their exported names in names (entries ending with '_' are prefixes) when either is
+    given, and must not match an exclude pattern.
+    """
+    # Suffixes of the names a metric is exported as, see exporter.Collector converters
+    suffixes = ('', '_count', '_sum', '_bucket')
+
+    def __init__(self, include=None, exclude=None, names=None):
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+        names = names or []
+        self.names = set(n for n in names if not n.endswith('_'))
+        self.prefixes = tuple(n for n in names if n.endswith('_'))
+        self.restricted = bool(self.include or names)
+
+    @staticmethod
+    def compile(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join('(?:{})'.format(p) for p in patterns))
+
+    def __call__(self, name, metric_name):
+        # name is the raw core metric name, metric_name its translated Prometheus name
+        if self.exclude and self.exclude.fullmatch(name):
+            return False
+        if not self.restricted:
+            return True
+        if self.include and self.include.fullmatch(name):
+            return True
+        for suffix in self.suffixes:
+            exported = metric_name + suffix
+            if exported in self.names or exported.startswith(self.prefixes):
+                return True
+        return False
+
+
+# Label value of the series aggregating label values over a SeriesLimit
+OVERFLOW_LABEL = '__overflow__'
+
+
+class SeriesLimit(object):
+    """Bounds the number of label values, and so series, a metric is exported with.
+
+    A label value keeps its slot while it is seen and for stale_after seconds after it was last seen,
+    so values churning between collections do not create new series. Values arriving while all limit
+    slots are taken are aggregated by the caller into one series labeled OVERFLOW_LABEL.
+    A limit of 0 disables the bound. Not thread safe, collections of a collector do not overlap.
+    """
+    def __init__(self, limit, stale_after=600):
+        self.limit = limit
+        self.stale_after = stale_after
+        # label value -> time it was last seen
+        self.seen = {}
+        # Number of values released by the last split() after being stale
+        self.expired = 0
+
+    def split(self, values):
+        """Returns the values exported as their own series and the values to aggregate."""
+        now = time.time()
+        current = set(values)
+        self.expired = 0
+        for value, last_seen in list(self.seen.items()):
+            if value not in current and now - last_seen > self.stale_after:
+                del self.seen[value]
+                self.expired += 1
+        kept = []
+        overflow = []
+        for value in values:
+            if value in self.seen or not self.limit or len(self.seen) < self.limit:
+                self.seen[value] = now
+                kept.append(value)
+            else:
+                overflow.append(value)
+        return kept, overflow
+
+
+class RateWindow(object):
+    """Ring buffer of metric values over recent collections, used to compute their change over a time window.
+
+    Collections share slots times, a collection taken less than window / slots seconds after the
+    first one recorded in the current slot replaces the previous one. Every metric has an array of
+    its values in each slot, prefixed with the time of the collection they were recorded in. Changes
+    are computed against the oldest collection at most window seconds old, or the newest older one.
+    Not thread safe, collections of a collector do not overlap.
+    """
+    def __init__(self, window, slots=16):
+        self.window = window
+        self.slots = slots
+        # time of the first collection recorded in the current slot
+        self.start = 0.0
+        # time of the last collection recorded in each slot, 0 for empty slots
+        self.times = array('d', [0.0]) * slots
+        # metric -> array of slots * (1 + number of values) floats
+        self.values = {}
+        self.current = None
+        self.base = None
+        self.elapsed = 0
+
+    def begin(self, now):
+        """Starts recording a collection taken at now."""
+        if self.current is None:
+            self.current = 0
+            self.start = now
+        elif now - self.start >= float(self.window) / self.slots:
+            self.current = (self.current + 1) % self.slots
+            self.start = now
+        self.times[self.current] = now
+        self.base = None
+        for i in range(1, self.slots):
+            slot = (self.current - i) % self.slots
+            taken = self.times[slot]
+            if not taken or taken >= now or (self.base is not None and now - taken > self.window):
+                break
+            self.base = slot
+        self.elapsed = now - self.times[self.base] if self.base is not None else 0
+
+    def change(self, key, values):
+        """Records values of metric key in the current collection.
+
+        Returns the change of every value since the base collection, None if key was not recorded in it.
+        """
+        width = len(values) + 1
+        ring = self.values.get(key)
+        if ring is None or len(ring) != width * self.slots:
+            ring = self.values[key] = array('d', [0.0]) * (width * self.slots)
+        start = self.current * width
+        ring[start] = self.times[self.current]
+        ring[start + 1:start + width] = array('d', values)
+        if self.base is None:
+            return None
+        base = self.base * width
+        if ring[base] != self.times[self.base]:
+            return None
+        return [value - ring[base + 1 + i] for i, value in enumerate(values)]
+
+
+class Stats(object):
+    """Thread safe store of exporter self-metrics, exported with to_registry().
+
+    Metrics are identified by name and a tuple of (label name, label value) pairs.
+    """
+    # Histogram buckets in seconds, from fast local work up to slow stellar-core responses
+    duration_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> [prom_type, description, value], value of histograms is
+        # [per bucket counts, count, sum]
+        self.metrics = OrderedDict()
+
+    def entry(self, name, description, prom_type, labels, value):
+        key = (name, labels)
+        entry = self.metrics.get(key)
+        if entry is None:
+            entry = self.metrics[key] = [prom_type, description, value]
+        return entry
+
+    def inc(self, name, description, labels=(), value=1):
+        # increments a counter
+        with self.lock:
+            self.entry(name, description, 'counter', labels, 0)[2] += value
+
+    def add(self, name, description, labels=(), value=1):
+        # adds value to a gauge
+        with self.lock:
+            self.entry(name, description, 'gauge', labels, 0)[2] += value
+
+    def set(self, name, description, value, labels=()):
+        # sets a gauge
+        with self.lock:
+            self.entry(name, description, 'gauge', labels, 0)[2] = value
+
+    def observe(self, name, description, value, labels=()):
+        # records value in a histogram with duration_buckets
+        with self.lock:
+            entry = self.entry(name, description, 'histogram', labels, None)
+            if entry[2] is None:
+                entry[2] = [[0] * len(self.duration_buckets), 0, 0]
+            buckets, _, _ = entry[2]
+            for i, bound in enumerate(self.duration_buckets):
+                if value <= bound:
+                    buckets[i] += 1
+                    break
+            entry[2][1] += 1
+            entry[2][2] += value
+
+    def to_registry(self, registry, labels=()):
+        # labels are prepended to the labels of every metric
+        # copy under the lock, histogram values are updated in place
+        with self.lock:
+            metrics = []
+            for (name, metric_labels), (prom_type, description, value) in self.metrics.items():
+                if prom_type == 'histogram':
+                    value = (list(value[0]), value[1], value[2])
+                metrics.append((name, labels + metric_labels, prom_type, description, value))
+        for name, labels, prom_type, description, value in metrics:
+            if prom_type == 'counter':
+                registry.Counter(name, description, value=value, labels=labels)
+            elif prom_type == 'gauge':
+                registry.Gauge(name, description, value=value, labels=labels)
+            else:
+                buckets, count_value, sum_value = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.duration_buckets, buckets):
+                    cumulative += bucket_count
+                    registry.Histogram(name, description, bucket=bound, value=cumulative, labels=labels)
+                registry.Histogram(name, description, bucket='+Inf', value=count_value, labels=labels)
+                registry.Summary(name, description, count_value=count_value, sum_value=sum_value, labels=labels,
+                                 prom_type='histogram')
+
+
+class Output(object):
+    """Rendered exposition which is compressed with gzip at most once.
+
+    Every response appends a small tail, like the exporter self-metrics, to data. The
+    compressor state after data is kept so only the tail is compressed per response.
+    """
+    def __init__(self, data, level):
+        self.data = data
+        self.level = level
+        self.lock = threading.Lock()
+        self.head = None
+        self.compressor = None
+
+    def gzip(self, tail):
+        # returns data followed by tail as a single gzip member
+        with self.lock:
+            if self.compressor is None:
+                self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                self.head = self.compressor.compress(self.data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            compressor = self.compressor.copy()
+        return self.head + compressor.compress(tail) + compressor.flush()
+
+
+def format_labels(labels):
+    # returns labels formatted for the exposition, without the enclosing braces
+    return ','.join(['{}="{}"'.format(k, v) for k, v in labels])
+
+
+def parse_labels(label_text):
+    # returns (label name, label value) pairs of labels formatted by format_labels
+    return LABEL_REGEX.findall(label_text)
+
+
+LABEL_REGEX = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="([^"]*)"')
+
+
+def family_header(name, description, prom_type):
+    return '# HELP {name} {description}\n# TYPE {name} {prom_type}\n'.format(
+        name=name, description=description, prom_type=prom_type)
+
+
+def openmetrics_header(name, description, prom_type):
+    # OpenMetrics counter samples are the family name followed by _total, counters without
+    # the suffix are exported as unknown so their series names do not depend on the format
+    if prom_type == 'counter':
+        if name.endswith('_total'):
+            name = name[:-len('_total')]
+        else:
+            prom_type = 'unknown'
+    elif prom_type == 'untyped':
+        prom_type = 'unknown'
+    return family_header(name, description, prom_type)
+
+
+def sample_prefix(name, label_text):
+    # returns the text of a sample up to its value
+    if label_text:
+        return '{}{{{}}} '.format(name, label_text)
+    return name + ' '
+
+
+def format_values(values):
+    # returns the exposition text of float values, integral values are written without a fraction
+    return ['%d' % v if v.is_integer() and -1e15 < v < 1e15 else format_float(v) for v in values]
+
+
+def format_float(value):
+    if math.isfinite(value):
+        return repr(value)
+    if math.isnan(value):
+        return 'NaN'
+    return '+Inf' if value > 0 else '-Inf'
+
+
+# Exposition formats
+TEXT = 'text'
+OPENMETRICS = 'openmetrics'
+PROTOBUF = 'protobuf'
+CONTENT_TYPES = {
+    TEXT: 'text/plain; version=0.0.4; charset=utf-8',
+    OPENMETRICS: 'application/openmetrics-text; version=1.0.0; charset=utf-8',
+    PROTOBUF: protobuf.CONTENT_TYPE,
+}
+# Trailer of an OpenMetrics exposition
+OPENMETRICS_EOF = b'# EOF\n'
+
+
+def negotiate(accept, openmetrics=False):
+    """Returns the exposition format preferred by an Accept header value.
+
+    Falls back to TEXT, which is also chosen by Prometheus servers not asking for other formats.
+    OPENMETRICS is only chosen if openmetrics is set, Prometheus prefers it by default but it
+    changes the metric type of counters not ending in _total, see openmetrics_header. Like
+    client_golang, the protobuf format must be asked for with encoding=delimited, other encodings
+    are not supported. OpenMetrics is served in version 1.0.0 only.
+    """
+    best = TEXT
+    best_q = 0
+    for media_range in (accept or '').split(','):
+        params = [p.strip() for p in media_range.split(';')]
+        media_type = params[0].lower()
+        q = 1.0
+        values = {}
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            name = name.strip().lower()
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+            else:
+                values[name] = value.strip().strip('"')
+        if media_type == 'application/openmetrics-text':
+            if not openmetrics or values.get('version', '1.0.0') != '1.0.0':
+                continue
+            fmt = OPENMETRICS
+        elif media_type == 'application/vnd.google.protobuf':
+            if values.get('proto') != 'io.prometheus.client.MetricFamily' or values.get('encoding') != 'delimited':
+                continue
+            fmt = PROTOBUF
+        elif media_type == 'text/plain':
+            fmt = TEXT
+        else:
+            continue
+        # the first of equally preferred formats wins
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+class Family(object):
+    """Samples of one metric family.
+
+    Sample i is the family name followed by suffixes[i], e.g. _count of a summary, with labels
+    formatted as label_texts[i] and value values[i].
+    """
+    __slots__ = ('description', 'prom_type', 'suffixes', 'label_texts', 'values')
+
+    def __init__(self, description, prom_type):
+        self.description = description
+        self.prom_type = prom_type
+        self.suffixes = []
+        self.label_texts = []
+        self.values = array('d')
+
+    def text(self, name, header):
+        return header + ''.join(
+            [(name + suffix + '{' + label_text + '} ' if label_text else name + suffix + ' ') + value + '\n'
+             for suffix, label_text, value in zip(self.suffixes, self.label_texts, format_values(self.values))])
+
+    def samples(self):
+        return list(zip(self.suffixes, self.label_texts, self.values))
+
+
+class Layout(object):
+    """Series of a completed Registry with their pre-rendered text.
+
+    keys holds (name, suffix, label text, description, type) of every sample in the order they
+    were added, families holds (name, description, type, header, [sample prefix, ...], array of
+    indexes in keys) in exposition order. A layout is never modified, registries of later
+    collections share it.
+    """
+    __slots__ = ('keys', 'families')
+
+    def __init__(self, keys=(), families=()):
+        self.keys = keys
+        self.families = families
+
+    @classmethod
+    def build(cls, added, metrics):
+        # added are the sample keys in order of addition, metrics is Registry.metrics
+        positions = {}
+        for i, key in enumerate(added):
+            positions.setdefault(key[0], array('L')).append(i)
+        families = []
+        for name, family in metrics.items():
+            families.append((name, family.description, family.prom_type,
+                             family_header(name, family.description, family.prom_type),
+                             [sample_prefix(name + suffix, label_text)
+                              for suffix, label_text in zip(family.suffixes, family.label_texts)],
+                             positions[name]))
+        return cls(added, families)
 
 
 class Registry(object):
-    def __init__(self, default_labels):
-        self.metrics = []
+    """Samples of one collection grouped into metric families.
+
+    Values are stored as doubles and formatted labels are shared between the samples of a
+    registry, so a sample costs little more than its value.
+
+    A registry created with the Layout of the previous collection only stores values as long
+    as samples are added in the same order with the same names and labels, which is the
+    common case as core rarely changes its metric set. On the first difference it falls back
+    to grouping samples itself and complete() returns a new Layout.
+    """
+    # Output is written in chunks of roughly this many characters
+    chunk_size = 64 * 1024
+
+    def __init__(self, default_labels, layout=None):
+        # metric family name -> Family
+        self.metrics = OrderedDict()
         self.default_labels = default_labels
+        self.default_label_text = format_labels(default_labels)
+        # labels -> formatted labels, (formatted labels, bucket type, bucket) -> formatted labels of the bucket
+        self.label_texts = {}
+        self.bucket_label_texts = {}
+        self.lock = threading.Lock()
+        # (format, native histogram schema) -> Output
+        self.rendered = {}
+        self.layout = layout
+        # values in order of addition while following layout
+        self.values = array('d') if layout is not None else None
+        # sample keys in order of addition after diverging from layout
+        self.added = None
 
     def list(self):
         print(self.metrics)
 
-    def render(self):
-        fmt = '# HELP {name} {description}\n# TYPE {name} {prom_type}\n{name}{{{labels}}} {value}\n'
-        txt = ''
-        for m in self.metrics:
-            name, description, labels, prom_type, value = m
-            label_text = ','.join(['{}="{}"'.format(k, v) for k, v in labels])
-            txt += fmt.format(description=description,
-                              name=name,
-                              labels=label_text,
-                              prom_type=prom_type,
-                              value=value,
-                              )
-        return txt.encode('utf-8')
-
-    def Summary(self, name, description, count_value, sum_value, labels=None):
-        self.metrics.append((name+'_count', description, labels or self.default_labels, 'summary', count_value))
-        self.metrics.append((name+'_sum', description, labels or self.default_labels, 'summary', sum_value))
+    def add(self, name, description, prom_type, label_text, value, suffix=''):
+        # adds a sample named name + suffix to the family name, the first sample of a family sets its type
+        if self.values is not None:
+            key = (name, suffix, label_text, description, prom_type)
+            position = len(self.values)
+            keys = self.layout.keys
+            if position < len(keys) and keys[position] == key:
+                self.values.append(value)
+                return
+            self.diverge()
+        if self.added is not None:
+            self.added.append((name, suffix, label_text, description, prom_type))
+        family = self.metrics.get(name)
+        if family is None:
+            family = self.metrics[name] = Family(description, prom_type)
+        family.values.append(value)
+        family.suffixes.append(suffix)
+        family.label_texts.append(label_text)
 
-    def Histogram(self, name, description, bucket, value, labels=None):
-        if labels:
-            new_labels = tuple(list(labels) + [("le", bucket)])
+    def diverge(self):
+        # stops following the layout, samples added so far are grouped into self.metrics
+        values = self.values
+        self.values = None
+        self.added = []
+        for (name, suffix, label_text, description, prom_type), value in zip(self.layout.keys, values):
+            self.add(name, description, prom_type, label_text, value, suffix)
+
+    def complete(self):
+        """Marks the registry as complete and returns its Layout for the next collection.
+
+        Returns None if the registry was not created with a layout.
+        """
+        if self.values is not None:
+            if len(self.values) == len(self.layout.keys):
+                return self.layout
+            # Some series of the previous collection are gone
+            self.diverge()
+        if self.added is None:
+            return None
+        return Layout.build(self.added, self.metrics)
+
+    def families(self):
+        # yields name, description, type and [(suffix, formatted labels, value), ...] of each family
+        if self.values is not None:
+            keys = self.layout.keys
+            values = self.values
+            for name, description, prom_type, _, _, positions in self.layout.families:
+                yield name, description, prom_type, [(keys[i][1], keys[i][2], values[i]) for i in positions]
+            return
+        for name, family in self.metrics.items():
+            yield name, family.description, family.prom_type, family.samples()
+
+    def family_texts(self, header=None):
+        # yields the exposition text of each metric family, header formats HELP and TYPE of
+        # a family in place of family_header
+        if self.values is not None:
+            values = format_values(self.values)
+            for name, description, prom_type, text, prefixes, positions in self.layout.families:
+                if header is not None:
+                    text = header(name, description, prom_type)
+                yield text + ''.join([prefix + values[i] + '\n' for prefix, i in zip(prefixes, positions)])
+            return
+        for name, family in self.metrics.items():
+            yield family.text(name, (header or family_header)(name, family.description, family.prom_type))
+
+    def family_messages(self, native_schema):
+        # yields the delimited protobuf MetricFamily message of each metric family
+        encoder = protobuf.Encoder(parse_labels, native_schema)
+        for name, description, prom_type, samples in self.families():
+            yield encoder.family(name, description, prom_type, samples)
+
+    def write(self, out, fmt=TEXT, native_schema=None):
+        """Writes the exposition to the file-like object out and returns the number of bytes written.
+
+        Samples are grouped by metric so HELP and TYPE are emitted once per metric. native_schema
+        adds native histograms with this schema to histograms in the PROTOBUF format.
+        The OPENMETRICS format needs to be followed by OPENMETRICS_EOF.
+        """
+        if fmt == PROTOBUF:
+            parts = self.family_messages(native_schema)
+        elif fmt == OPENMETRICS:
+            parts = (text.encode('utf-8') for text in self.family_texts(openmetrics_header))
         else:
-            new_labels = tuple(list(self.default_labels) + [("le", bucket)])
-        self.metrics.append((name+'_bucket', description, new_labels, 'histogram', value))
+            parts = (text.encode('utf-8') for text in self.family_texts())
+        written = 0
+        chunk = []
+        size = 0
+        for data in parts:
+            chunk.append(data)
+            size += len(data)
+            if size >= self.chunk_size:
+                out.write(b''.join(chunk))
+                written += size
+                chunk = []
+                size = 0
+        if chunk:
+            out.write(b''.join(chunk))
+            written += size
+        return written
+
+    def sample_count(self):
+        if self.values is not None:
+            return len(self.values)
+        return sum(len(family.values) for family in self.metrics.values())
+
+    def render(self, fmt=TEXT, native_schema=None):
+        out = io.BytesIO()
+        self.write(out, fmt, native_schema)
+        return out.getvalue()
+
+    def output(self, level, fmt=TEXT, native_schema=None):
+        # returns the rendered registry as an Output, rendered once per format for all callers
+        key = (fmt, native_schema)
+        with self.lock:
+            output = self.rendered.get(key)
+            if output is None:
+                output = self.rendered[key] = Output(self.render(fmt, native_schema), level)
+            return output
+
+    def labels_text(self, labels):
+        if not labels:
+            return self.default_label_text
+        label_text = self.label_texts.get(labels)
+        if label_text is None:
+            label_text = self.label_texts[labels] = format_labels(labels)
+        return label_text
+
+    def Summary(self, name, description, count_value, sum_value, labels=None, prom_type='summary'):
+        # adds _count and _sum samples, also used for histograms with prom_type 'histogram'
+        label_text = self.labels_text(labels)
+        self.add(name, description, prom_type, label_text, count_value, '_count')
+        self.add(name, description, prom_type, label_text, sum_value, '_sum')
+
+    def Quantile(self, name, description, value, labels=None):
+        # labels of a summary quantile include the quantile label
+        self.add(name, description, 'summary', self.labels_text(labels), value)
+
+    def Histogram(self, name, description, bucket, value, labels=None):
+        label_text = self.labels_text(labels)
+        # 1 and 1.0 are equal keys but render differently
+        key = (label_text, type(bucket), bucket)
+        bucket_label_text = self.bucket_label_texts.get(key)
+        if bucket_label_text is None:
+            le = 'le="{}"'.format(bucket)
+            bucket_label_text = self.bucket_label_texts[key] = label_text + ',' + le if label_text else le
+        self.add(name, description, 'histogram', bucket_label_text, value, '_bucket')
 
     def Counter(self, name, description, value, labels=None):
-        self.metrics.append((name, description, labels or self.default_labels, 'counter', value))
+        self.add(name, description, 'counter', self.labels_text(labels), value)
 
     def Gauge(self, name, description, value, labels=None):
-        self.metrics.append((name, description, labels or self.default_labels, 'gauge', value))
+        self.add(name, description, 'gauge', self.labels_text(labels), value)
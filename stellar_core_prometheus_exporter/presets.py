@@ -0,0 +1,259 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Metric presets derived from the Grafana dashboards shipped with the exporter.
+
+Each preset lists the metric names referenced by a dashboard, names ending with an
+underscore are prefixes (dashboard templates such as stellar_core_overlay_${overlay_metric}).
+Regenerate after changing a dashboard with:
+
+    python -m stellar_core_prometheus_exporter.presets grafana-dashboard-monitoring.json
+"""
+
+import re
+import sys
+
+
+def dashboard_metrics(path):
+    # returns sorted names of all stellar-core metrics referenced by a dashboard
+    with open(path) as f:
+        return sorted(set(re.findall(r'stellar_core_[a-zA-Z0-9_]+', f.read())))
+
+
+MONITORING = [
+    'stellar_core_app_post_on_background_thread_delay_seconds',
+    'stellar_core_app_post_on_background_thread_delay_seconds_count',
+    'stellar_core_app_post_on_background_thread_delay_seconds_sum',
+    'stellar_core_app_post_on_main_thread_delay_seconds',
+    'stellar_core_app_post_on_main_thread_delay_seconds_count',
+    'stellar_core_app_post_on_main_thread_delay_seconds_sum',
+    'stellar_core_bucket_batch_addtime_seconds',
+    'stellar_core_bucket_batch_addtime_seconds_count',
+    'stellar_core_bucket_batch_addtime_seconds_sum',
+    'stellar_core_bucket_batch_objectsadded',
+    'stellar_core_bucket_memory_shared',
+    'stellar_core_crypto_verify_hit',
+    'stellar_core_crypto_verify_total',
+    'stellar_core_ledger_age',
+    'stellar_core_ledger_age_closed_bucket',
+    'stellar_core_ledger_age_closed_count',
+    'stellar_core_ledger_age_closed_sum',
+    'stellar_core_ledger_operation_count_count',
+    'stellar_core_ledger_operation_count_sum',
+    'stellar_core_ledger_transaction_count_count',
+    'stellar_core_ledger_transaction_count_sum',
+    'stellar_core_overlay_connection_authenticated',
+    'stellar_core_overlay_connection_pending',
+    'stellar_core_overlay_timeout_idle',
+    'stellar_core_overlay_timeout_straggler',
+    'stellar_core_quorum_delayed',
+    'stellar_core_quorum_fail_at',
+    'stellar_core_quorum_missing',
+    'stellar_core_quorum_transitive_critical',
+    'stellar_core_quorum_transitive_intersection',
+    'stellar_core_quorum_transitive_last_check_ledger',
+    'stellar_core_started_on',
+    'stellar_core_synced',
+]
+
+FULL = [
+    'stellar_core_app_post_on_background_thread_delay_seconds',
+    'stellar_core_app_post_on_background_thread_delay_seconds_count',
+    'stellar_core_app_post_on_background_thread_delay_seconds_sum',
+    'stellar_core_app_post_on_main_thread_delay_seconds',
+    'stellar_core_app_post_on_main_thread_delay_seconds_count',
+    'stellar_core_app_post_on_main_thread_delay_seconds_sum',
+    'stellar_core_app_post_on_main_thread_with_delay_delay_seconds',
+    'stellar_core_app_post_on_main_thread_with_delay_delay_seconds_count',
+    'stellar_core_app_post_on_main_thread_with_delay_delay_seconds_sum',
+    'stellar_core_app_state_current',
+    'stellar_core_booting',
+    'stellar_core_bucket_batch_addtime_seconds',
+    'stellar_core_bucket_batch_addtime_seconds_count',
+    'stellar_core_bucket_batch_addtime_seconds_sum',
+    'stellar_core_bucket_batch_objectsadded',
+    'stellar_core_bucket_memory_shared',
+    'stellar_core_bucket_snap_merge_seconds',
+    'stellar_core_bucket_snap_merge_seconds_count',
+    'stellar_core_bucket_snap_merge_seconds_sum',
+    'stellar_core_catching_up',
+    'stellar_core_connected',
+    'stellar_core_crypto_verify_hit',
+    'stellar_core_crypto_verify_miss',
+    'stellar_core_crypto_verify_total',
+    'stellar_core_database_',
+    'stellar_core_database_query_exec',
+    'stellar_core_herder_pending_txs_age0',
+    'stellar_core_herder_pending_txs_age1',
+    'stellar_core_herder_pending_txs_age2',
+    'stellar_core_herder_pending_txs_age3',
+    'stellar_core_herder_pending_txs_banned',
+    'stellar_core_herder_pending_txs_delay_seconds',
+    'stellar_core_herder_pending_txs_delay_seconds_count',
+    'stellar_core_herder_pending_txs_delay_seconds_sum',
+    'stellar_core_history_apply_ledger_chain_failure',
+    'stellar_core_history_apply_ledger_chain_success',
+    'stellar_core_history_archive_',
+    'stellar_core_history_bucket_apply_failure',
+    'stellar_core_history_bucket_apply_success',
+    'stellar_core_history_download_bucket_failure',
+    'stellar_core_history_download_bucket_success',
+    'stellar_core_history_download_history_archive_state_success',
+    'stellar_core_history_download_ledger_failure',
+    'stellar_core_history_download_ledger_success',
+    'stellar_core_history_download_transactions_failure',
+    'stellar_core_history_download_transactions_success',
+    'stellar_core_history_publish_failure',
+    'stellar_core_history_publish_success',
+    'stellar_core_history_publish_time_seconds',
+    'stellar_core_history_publish_time_seconds_count',
+    'stellar_core_history_publish_time_seconds_sum',
+    'stellar_core_history_verify_bucket_failure',
+    'stellar_core_history_verify_bucket_success',
+    'stellar_core_history_verify_ledger_chain_failure',
+    'stellar_core_history_verify_ledger_chain_success',
+    'stellar_core_history_verify_ledger_success',
+    'stellar_core_joining_scp',
+    'stellar_core_ledger_age',
+    'stellar_core_ledger_age_closed_bucket',
+    'stellar_core_ledger_age_closed_count',
+    'stellar_core_ledger_age_closed_sum',
+    'stellar_core_ledger_catchup_duration_seconds_count',
+    'stellar_core_ledger_catchup_duration_seconds_sum',
+    'stellar_core_ledger_invariant_failure',
+    'stellar_core_ledger_ledger_close_seconds',
+    'stellar_core_ledger_ledger_close_seconds_count',
+    'stellar_core_ledger_ledger_close_seconds_sum',
+    'stellar_core_ledger_memory_queued_ledgers',
+    'stellar_core_ledger_operation_apply_seconds',
+    'stellar_core_ledger_operation_apply_seconds_count',
+    'stellar_core_ledger_operation_apply_seconds_sum',
+    'stellar_core_ledger_operation_count',
+    'stellar_core_ledger_operation_count_count',
+    'stellar_core_ledger_operation_count_sum',
+    'stellar_core_ledger_prefetch_hit_rate',
+    'stellar_core_ledger_prefetch_hit_rate_count',
+    'stellar_core_ledger_prefetch_hit_rate_sum',
+    'stellar_core_ledger_transaction_apply_seconds',
+    'stellar_core_ledger_transaction_apply_seconds_count',
+    'stellar_core_ledger_transaction_apply_seconds_sum',
+    'stellar_core_ledger_transaction_count',
+    'stellar_core_ledger_transaction_count_count',
+    'stellar_core_ledger_transaction_count_sum',
+    'stellar_core_ledger_transaction_internal_error',
+    'stellar_core_ledger_version',
+    'stellar_core_overlay_',
+    'stellar_core_overlay_async_read',
+    'stellar_core_overlay_async_write',
+    'stellar_core_overlay_byte_read',
+    'stellar_core_overlay_byte_write',
+    'stellar_core_overlay_connection_authenticated',
+    'stellar_core_overlay_connection_pending',
+    'stellar_core_overlay_error_read',
+    'stellar_core_overlay_error_write',
+    'stellar_core_overlay_fetch_duplicate_recv',
+    'stellar_core_overlay_fetch_unique_recv',
+    'stellar_core_overlay_flood_broadcast',
+    'stellar_core_overlay_flood_duplicate_recv',
+    'stellar_core_overlay_flood_unique_recv',
+    'stellar_core_overlay_inbound_attempt',
+    'stellar_core_overlay_inbound_drop',
+    'stellar_core_overlay_inbound_establish',
+    'stellar_core_overlay_inbound_reject',
+    'stellar_core_overlay_item_fetcher_next_peer',
+    'stellar_core_overlay_memory_flood_known',
+    'stellar_core_overlay_message_broadcast',
+    'stellar_core_overlay_message_drop',
+    'stellar_core_overlay_message_read',
+    'stellar_core_overlay_message_write',
+    'stellar_core_overlay_outbound_attempt',
+    'stellar_core_overlay_outbound_drop',
+    'stellar_core_overlay_outbound_establish',
+    'stellar_core_overlay_outbound_reject',
+    'stellar_core_overlay_send_auth',
+    'stellar_core_overlay_send_dont_have',
+    'stellar_core_overlay_send_error',
+    'stellar_core_overlay_send_get_peers',
+    'stellar_core_overlay_send_get_scp_qset',
+    'stellar_core_overlay_send_get_scp_state',
+    'stellar_core_overlay_send_get_txset',
+    'stellar_core_overlay_send_hello',
+    'stellar_core_overlay_send_peers',
+    'stellar_core_overlay_send_scp_message',
+    'stellar_core_overlay_send_scp_qset',
+    'stellar_core_overlay_send_survey_request',
+    'stellar_core_overlay_send_survey_response',
+    'stellar_core_overlay_send_transaction',
+    'stellar_core_overlay_timeout_idle',
+    'stellar_core_overlay_timeout_straggler',
+    'stellar_core_peers_authenticated_count',
+    'stellar_core_peers_pending_count',
+    'stellar_core_process_action_overloaded',
+    'stellar_core_process_action_queue',
+    'stellar_core_protocol_version',
+    'stellar_core_quorum_agree',
+    'stellar_core_quorum_delayed',
+    'stellar_core_quorum_disagree',
+    'stellar_core_quorum_fail_at',
+    'stellar_core_quorum_missing',
+    'stellar_core_quorum_phase_confirm',
+    'stellar_core_quorum_phase_externalize',
+    'stellar_core_quorum_phase_prepare',
+    'stellar_core_quorum_phase_unknown',
+    'stellar_core_quorum_transitive_critical',
+    'stellar_core_quorum_transitive_intersection',
+    'stellar_core_quorum_transitive_last_check_ledger',
+    'stellar_core_quorum_transitive_node_count',
+    'stellar_core_scp_envelope_emit',
+    'stellar_core_scp_envelope_invalidsig',
+    'stellar_core_scp_envelope_receive',
+    'stellar_core_scp_envelope_sign',
+    'stellar_core_scp_envelope_validsig',
+    'stellar_core_scp_fetch_envelope_seconds',
+    'stellar_core_scp_fetch_envelope_seconds_count',
+    'stellar_core_scp_fetch_envelope_seconds_sum',
+    'stellar_core_scp_memory_cumulative_statements',
+    'stellar_core_scp_nomination_combinecandidates',
+    'stellar_core_scp_pending_discarded',
+    'stellar_core_scp_pending_fetching',
+    'stellar_core_scp_pending_processed',
+    'stellar_core_scp_pending_ready',
+    'stellar_core_scp_sync_lost',
+    'stellar_core_scp_timeout_nominate',
+    'stellar_core_scp_timeout_nominate_count',
+    'stellar_core_scp_timeout_nominate_sum',
+    'stellar_core_scp_timeout_prepare',
+    'stellar_core_scp_timeout_prepare_count',
+    'stellar_core_scp_timeout_prepare_sum',
+    'stellar_core_scp_timing_externalize_delay_seconds',
+    'stellar_core_scp_timing_externalize_delay_seconds_count',
+    'stellar_core_scp_timing_externalize_delay_seconds_sum',
+    'stellar_core_scp_timing_externalize_lag_seconds',
+    'stellar_core_scp_timing_externalize_lag_seconds_count',
+    'stellar_core_scp_timing_externalize_lag_seconds_sum',
+    'stellar_core_scp_timing_externalized_seconds',
+    'stellar_core_scp_timing_externalized_seconds_count',
+    'stellar_core_scp_timing_externalized_seconds_sum',
+    'stellar_core_scp_timing_first_to_self_externalize_lag_seconds',
+    'stellar_core_scp_timing_first_to_self_externalize_lag_seconds_count',
+    'stellar_core_scp_timing_first_to_self_externalize_lag_seconds_sum',
+    'stellar_core_scp_timing_nominated_seconds',
+    'stellar_core_scp_timing_nominated_seconds_count',
+    'stellar_core_scp_timing_nominated_seconds_sum',
+    'stellar_core_scp_timing_self_to_others_externalize_lag_seconds',
+    'stellar_core_scp_timing_self_to_others_externalize_lag_seconds_count',
+    'stellar_core_scp_timing_self_to_others_externalize_lag_seconds_sum',
+    'stellar_core_scp_value_invalid',
+    'stellar_core_scp_value_valid',
+    'stellar_core_started_on',
+    'stellar_core_synced',
+]
+
+PRESETS = {
+    'monitoring': MONITORING,
+    'full': FULL,
+}
+
+
+if __name__ == "__main__":
+    for name in dashboard_metrics(sys.argv[1]):
+        print("    '{}',".format(name))
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Encoder of the Prometheus protobuf exposition format.
+
+Writes length delimited io.prometheus.client.MetricFamily messages as defined in metrics.proto
+of prometheus/client_model, only the fields used by the exporter are supported.
+"""
+
+import math
+import struct
+from collections import OrderedDict
+
+
+CONTENT_TYPE = 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited'
+
+# MetricType enum
+METRIC_TYPES = {'counter': 0, 'gauge': 1, 'summary': 2, 'untyped': 3, 'histogram': 4}
+
+# Smallest positive value counted in a regular native histogram bucket, same default as client_golang.
+# A non zero threshold also marks an empty histogram as native.
+ZERO_THRESHOLD = 2.0 ** -128
+
+
+# Encodings of values below 128, most field keys and lengths are in this range
+SMALL_VARINTS = [struct.pack('B', i) for i in range(128)]
+
+
+def varint(value):
+    if value < 128:
+        return SMALL_VARINTS[value]
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def varint_field(number, value):
+    return varint(number << 3) + varint(value)
+
+
+def sint_field(number, value):
+    # zigzag encoded signed varint
+    return varint_field(number, value << 1 if value >= 0 else -2 * value - 1)
+
+
+def double_field(number, value):
+    return varint(number << 3 | 1) + struct.pack('<d', value)
+
+
+def bytes_field(number, data):
+    return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+def string_field(number, text):
+    return bytes_field(number, text.encode('utf-8'))
+
+
+def native_buckets(buckets, schema):
+    """Converts classic buckets, sorted (upper bound, cumulative count) pairs, into a native histogram.
+
+    The count of each classic bucket is put into the exponential bucket holding its upper bound,
+    counts of the +Inf bucket into the exponential bucket following the last finite bound.
+    Returns the Histogram fields of the zero bucket and positive buckets.
+    """
+    factor = 2.0 ** schema
+    zero_count = 0
+    counts = OrderedDict()
+    previous_cumulative = 0
+    previous_index = None
+    for bound, cumulative in buckets:
+        count = cumulative - previous_cumulative
+        previous_cumulative = cumulative
+        if bound <= ZERO_THRESHOLD:
+            zero_count += count
+            continue
+        if math.isinf(bound):
+            index = previous_index + 1 if previous_index is not None else 0
+        else:
+            index = int(math.ceil(math.log(bound, 2) * factor))
+        previous_index = index
+        counts[index] = counts.get(index, 0) + count
+
+    fields = [sint_field(5, schema), double_field(6, ZERO_THRESHOLD), varint_field(7, int(zero_count))]
+    spans = []
+    deltas = []
+    previous_count = 0
+    end = None
+    for index, count in counts.items():
+        if end is not None and index == end:
+            spans[-1][1] += 1
+        else:
+            spans.append([index - end if end is not None else index, 1])
+        end = index + 1
+        deltas.append(int(count) - previous_count)
+        previous_count = int(count)
+    for offset, length in spans:
+        fields.append(bytes_field(12, sint_field(1, offset) + varint_field(2, length)))
+    fields.extend([sint_field(13, delta) for delta in deltas])
+    return fields
+
+
+class Encoder(object):
+    """Encodes the metric families of an exposition.
+
+    parse_labels returns (label name, label value) pairs of labels formatted by lib.format_labels,
+    the encoding of each distinct formatted labels is cached as most samples share them.
+    native_schema adds native histograms with this schema to histograms.
+    """
+    def __init__(self, parse_labels, native_schema=None):
+        self.parse_labels = parse_labels
+        self.native_schema = native_schema
+        # (suffix, formatted labels) -> (encoded LabelPair fields without quantile or le, quantile or le)
+        self.labels = {}
+
+    def split_labels(self, suffix, label_text):
+        key = (suffix, label_text)
+        entry = self.labels.get(key)
+        if entry is None:
+            fields = []
+            bound = None
+            for k, v in self.parse_labels(label_text):
+                if (k == 'quantile' and suffix == '') or (k == 'le' and suffix == '_bucket'):
+                    bound = float(v)
+                else:
+                    fields.append(bytes_field(1, string_field(1, k) + string_field(2, v)))
+            entry = self.labels[key] = (b''.join(fields), bound)
+        return entry
+
+    def family(self, name, description, prom_type, samples):
+        """Returns a delimited MetricFamily message.
+
+        samples are (name suffix, formatted labels, value) triples of the family.
+        """
+        metrics = []
+        if prom_type in ('summary', 'histogram'):
+            # Samples of one metric share their labels except quantile or le
+            grouped = OrderedDict()
+            for suffix, label_text, value in samples:
+                labels, bound = self.split_labels(suffix, label_text)
+                metric = grouped.get(labels)
+                if metric is None:
+                    metric = grouped[labels] = [0, 0, []]
+                if suffix == '_count':
+                    metric[0] = value
+                elif suffix == '_sum':
+                    metric[1] = value
+                elif bound is not None:
+                    metric[2].append((bound, value))
+            for labels, (count_value, sum_value, points) in grouped.items():
+                fields = [varint_field(1, int(count_value)), double_field(2, sum_value)]
+                if prom_type == 'summary':
+                    fields.extend([bytes_field(3, double_field(1, q) + double_field(2, v)) for q, v in points])
+                    metrics.append(labels + bytes_field(4, b''.join(fields)))
+                    continue
+                points.sort()
+                fields.extend([bytes_field(3, varint_field(1, int(v)) + double_field(2, le)) for le, v in points])
+                if self.native_schema is not None:
+                    fields.extend(native_buckets(points, self.native_schema))
+                metrics.append(labels + bytes_field(7, b''.join(fields)))
+        else:
+            field = {'counter': 3, 'gauge': 2}.get(prom_type, 5)
+            for suffix, label_text, value in samples:
+                metrics.append(self.split_labels(suffix, label_text)[0] + bytes_field(field, double_field(1, value)))
+
+        message = b''.join([string_field(1, name), string_field(2, description),
+                            varint_field(3, METRIC_TYPES.get(prom_type, 3))] +
+                           [bytes_field(4, metric) for metric in metrics])
+        return varint(len(message)) + message
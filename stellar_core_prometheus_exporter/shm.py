@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+"""Multi-process serving mode.
+
+The main process polls stellar-core and writes every rendered snapshot into shared memory,
+worker processes forked from it serve scrapes straight from the shared memory. Rendering and
+JSON decoding stay in the main process while serving scales over CPU cores.
+"""
+
+import mmap
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+from urllib.parse import urlparse
+
+from . import lib
+from .exporter import (CollectionError, StellarCoreHandler, _ThreadingSimpleServer, accepts_gzip,
+                       exporter_metrics, find_target, scrape_tail)
+
+
+# Variants of a snapshot, a buffer holds the body of each variant rendered so far
+VARIANTS = [(fmt, compress) for fmt in (lib.TEXT, lib.OPENMETRICS, lib.PROTOBUF) for compress in (False, True)]
+
+# generation, reader count of both buffers, wanted flag of each variant
+HEADER = struct.Struct('<QQQ{}B'.format(len(VARIANTS)))
+# status code, offset and length of the body of each variant
+DIRECTORY = struct.Struct('<Q{}Q'.format(2 * len(VARIANTS)))
+
+
+class SharedSnapshot(object):
+    """Double buffered responses shared by the main process with the worker processes.
+
+    A shared memory map created before the workers are forked holds a header and two buffers of
+    buffer_size bytes. The main process writes a new snapshot into the inactive buffer and makes it
+    active by incrementing the generation, workers send the active buffer without copying it.
+    Buffers are not overwritten while workers still send them, unless a worker holds a buffer
+    longer than stall_timeout seconds, e.g. when it was killed in the middle of a response.
+    """
+    stall_timeout = 10
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.map = mmap.mmap(-1, HEADER.size + 2 * buffer_size)
+        self.view = memoryview(self.map)
+        # Guards the generation and reader counts
+        self.lock = multiprocessing.Lock()
+
+    def buffer_offset(self, buffer):
+        return HEADER.size + buffer * self.buffer_size
+
+    def header(self):
+        return HEADER.unpack_from(self.map, 0)
+
+    def acquire(self):
+        # Returns the active buffer, which must be released, or None if nothing was published yet
+        with self.lock:
+            header = self.header()
+            generation = header[0]
+            if not generation:
+                return None
+            buffer = generation % 2
+            struct.pack_into('<Q', self.map, 8 + 8 * buffer, header[1 + buffer] + 1)
+        return buffer
+
+    def release(self, buffer):
+        with self.lock:
+            readers = struct.unpack_from('<Q', self.map, 8 + 8 * buffer)[0]
+            struct.pack_into('<Q', self.map, 8 + 8 * buffer, readers - 1)
+
+    def response(self, buffer, fmt, compress):
+        """Returns status code, body, format and whether the body is compressed of an acquired buffer.
+
+        The body of a variant which was not published is replaced by the text format, or by the
+        uncompressed body, and the variant is published from the next snapshot on.
+        """
+        start = self.buffer_offset(buffer)
+        directory = DIRECTORY.unpack_from(self.map, start)
+        status = directory[0]
+        if status != 200:
+            # Error message in the first variant
+            return status, self.view[start + directory[1]:start + directory[1] + directory[2]], lib.TEXT, False
+        variants = [(fmt, compress), (fmt, False), (lib.TEXT, compress), (lib.TEXT, False)]
+        for variant in variants:
+            index = VARIANTS.index(variant)
+            offset, length = directory[1 + 2 * index:3 + 2 * index]
+            if length:
+                break
+        if variant != variants[0]:
+            self.map[HEADER.size - len(VARIANTS) + VARIANTS.index(variants[0])] = 1
+        return status, self.view[start + offset:start + offset + length], variant[0], variant[1]
+
+    def wanted(self, index):
+        return self.map[HEADER.size - len(VARIANTS) + index]
+
+    def publish(self, bodies, status=200):
+        """Makes bodies, a dict of VARIANTS index to response body, the active snapshot.
+
+        Raises ValueError if the bodies do not fit into a buffer.
+        """
+        size = DIRECTORY.size + sum(len(body) for body in bodies.values())
+        if size > self.buffer_size:
+            raise ValueError('Snapshot of {} bytes does not fit into the shared buffer of {} bytes'.format(
+                size, self.buffer_size))
+        with self.lock:
+            generation = self.header()[0]
+        buffer = (generation + 1) % 2
+        deadline = time.time() + self.stall_timeout
+        while time.time() < deadline:
+            with self.lock:
+                if not self.header()[1 + buffer]:
+                    break
+            time.sleep(0.001)
+
+        start = self.buffer_offset(buffer)
+        directory = [status] + [0] * (2 * len(VARIANTS))
+        offset = DIRECTORY.size
+        for index, body in bodies.items():
+            self.map[start + offset:start + offset + len(body)] = body
+            directory[1 + 2 * index:3 + 2 * index] = [offset, len(body)]
+            offset += len(body)
+        DIRECTORY.pack_into(self.map, start, *directory)
+        with self.lock:
+            struct.pack_into('<Q', self.map, 0, generation + 1)
+
+
+class Publisher(object):
+    """Polls a target like exporter.Poller and publishes every snapshot to a SharedSnapshot."""
+    def __init__(self, poller, shared, gzip_level=6, native_histogram_schema=None):
+        self.poller = poller
+        self.shared = shared
+        self.gzip_level = gzip_level
+        self.native_histogram_schema = native_histogram_schema
+
+    def publish(self):
+        collector = self.poller.collector
+        try:
+            registry = self.poller.snapshot()
+        except CollectionError as e:
+            self.shared.publish({0: '{}\n'.format(e.msg).encode('utf-8')}, e.code)
+            return
+        bodies = {}
+        for index, (fmt, compress) in enumerate(VARIANTS):
+            # Text is always published, other formats once a scraper requested them
+            if (compress and not self.gzip_level) or (fmt != lib.TEXT and not self.shared.wanted(index)):
+                continue
+            output = registry.output(self.gzip_level, fmt, self.native_histogram_schema)
+            tail = scrape_tail(self.poller, fmt, self.native_histogram_schema)
+            bodies[index] = output.gzip(tail) if compress else output.data + tail
+        try:
+            self.shared.publish(bodies)
+        except ValueError:
+            # The previous snapshot stays active
+            collector.stats.inc('stellar_core_exporter_errors_total', 'Failed collections by endpoint and reason',
+                                (('endpoint', ''), ('reason', 'shared_buffer')))
+            return
+        collector.response_sizes(len(bodies[0]), bodies.get(1) and len(bodies[1]))
+
+    def run(self):
+        while True:
+            started = time.time()
+            self.poller.poll()
+            try:
+                self.publish()
+            except Exception as e:
+                # Like Poller.poll, serve the error and keep publishing later snapshots
+                self.poller.collector.stats.inc('stellar_core_exporter_errors_total',
+                                                'Failed collections by endpoint and reason',
+                                                (('endpoint', ''), ('reason', 'publish')))
+                self.shared.publish({0: 'Error publishing metrics: {}\n'.format(e).encode('utf-8')}, 500)
+            time.sleep(max(0, self.poller.interval - (time.time() - started)))
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+
+class WorkerHandler(StellarCoreHandler):
+    """Serves scrapes from the SharedSnapshot of each target, server.targets maps target names to them.
+
+    server.gzip_level is the gzip level of the publishers, server.openmetrics enables the OpenMetrics format.
+    """
+    def do_GET(self):
+        if urlparse(self.path).path == '/exporter-metrics':
+            self.send_snapshot(self.server.exporter_snapshot, lib.TEXT, False)
+            return
+        try:
+            shared = find_target(self.server.targets, self.path)
+        except CollectionError as e:
+            self.error(e.code, e.msg)
+            return
+        # Compressed variants are never published with gzip level 0
+        compress = bool(self.server.gzip_level) and accepts_gzip(self.headers.get('Accept-Encoding'))
+        self.send_snapshot(shared, lib.negotiate(self.headers.get('Accept'), self.server.openmetrics), compress)
+
+    def send_snapshot(self, shared, fmt, compress):
+        buffer = shared.acquire()
+        if buffer is None:
+            self.error(503, 'Error - no metrics were collected yet')
+            return
+        try:
+            status, body, fmt, compressed = shared.response(buffer, fmt, compress)
+            self.send_response(status)
+            self.send_header('Content-Type', lib.CONTENT_TYPES[fmt] if status == 200 else self.content_type)
+            if compressed:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            shared.release(buffer)
+
+
+def watch_parent(parent):
+    # Exits a worker once the main process is gone
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(1)
+
+
+def serve(port, targets, workers, gzip_level=6, native_histogram_schema=None, buffer_size=64 * 2**20,
+          openmetrics=False):
+    """Serves targets, a dict of target name to (exporter.Collector, exporter.Poller), from workers processes.
+
+    Pollers must not be started yet, workers are forked before any thread is started. buffer_size
+    is the size of each of the two shared buffers of a target, openmetrics serves the OpenMetrics
+    format to scrapers preferring it.
+    """
+    shared = {name: SharedSnapshot(buffer_size) for name in targets}
+    # Pages of the shared memory are only allocated once written to
+    exporter_snapshot = SharedSnapshot(buffer_size)
+    # Workers accept connections on the listening socket of the main process
+    httpd = _ThreadingSimpleServer(("", port), WorkerHandler)
+    httpd.targets = shared
+    httpd.exporter_snapshot = exporter_snapshot
+    httpd.gzip_level = gzip_level
+    httpd.openmetrics = openmetrics
+    parent = os.getpid()
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                t = threading.Thread(target=watch_parent, args=(parent,))
+                t.daemon = True
+                t.start()
+                httpd.serve_forever()
+            finally:
+                os._exit(1)
+        children.append(pid)
+    httpd.server_close()
+
+    try:
+        for name, (collector, poller) in targets.items():
+            Publisher(poller, shared[name], gzip_level, native_histogram_schema).start()
+        while True:
+            try:
+                exporter_snapshot.publish({0: exporter_metrics(targets)})
+            except ValueError as e:
+                # Workers keep serving, a restart with a larger buffer is needed
+                exporter_snapshot.publish({0: '{}\n'.format(e).encode('utf-8')}, 500)
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                raise RuntimeError('Worker process {} exited'.format(pid))
+            time.sleep(1)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
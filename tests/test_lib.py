@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+
+import unittest
+
+from stellar_core_prometheus_exporter import lib
+
+
+def collect(window, interval, collections):
+    # Returns (time, changes, elapsed) of collections of a counter growing by 1 every interval seconds
+    results = []
+    for i in range(collections):
+        now = 1000000.0 + i * interval
+        window.begin(now)
+        results.append((now, window.change('counter', [i]), window.elapsed))
+    return results
+
+
+GOOD_DOCUMENTS = [
+    (b'{"metrics": {}}', []),
+    (b'{"metrics": {"a": {"type": "counter", "count": 1}, "b": 2}}', [('a', {'type': 'counter', 'count': 1}),
+                                                                     ('b', 2)]),
+    (b' {"other": [1, {"metrics": 3}], "metrics": {"a": 1.5}, "more": {}} \n', [('a', 1.5)]),
+]
+
+BAD_DOCUMENTS = [
+    b'',
+    b'{}',
+    b'{"other": 1}',
+    b'[1]',
+    b'{"metrics": []}',
+    b'{"metrics": 1}',
+    b'{"metrics": {"a": 1}',
+    b'{"metrics": {"a": 1}, "other": 1',
+    b'{"metrics": {"a": 1}} {}',
+    b'{"metrics": {"a": }}',
+]
+
+
+class IterMetricsTest(unittest.TestCase):
+    def check_parser(self, parse):
+        for document, metrics in GOOD_DOCUMENTS:
+            self.assertEqual(list(parse(document)), metrics, document)
+        for document in BAD_DOCUMENTS:
+            with self.assertRaises(ValueError, msg=document):
+                list(parse(document))
+
+    def test_json(self):
+        self.check_parser(lib.iter_metrics_json)
+
+    def test_ijson(self):
+        if not lib.load_ijson():
+            self.skipTest('ijson is not installed')
+        self.check_parser(lib.iter_metrics)
+
+
+# Accept headers sent by Prometheus
+PROMETHEUS_2 = ('application/openmetrics-text;version=1.0.0,application/openmetrics-text;version=0.0.1;q=0.75,'
+                'text/plain;version=0.0.4;q=0.5,*/*;q=0.1')
+PROMETHEUS_2_NATIVE_HISTOGRAMS = ('application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;'
+                                  'encoding=delimited,application/openmetrics-text;version=1.0.0;q=0.8,'
+                                  'application/openmetrics-text;version=0.0.1;q=0.75,'
+                                  'text/plain;version=0.0.4;q=0.5,*/*;q=0.1')
+PROMETHEUS_3 = ('application/openmetrics-text;version=1.0.0;escaping=allow-utf-8;q=0.5,'
+                'application/openmetrics-text;version=0.0.1;q=0.4,'
+                'text/plain;version=1.0.0;escaping=allow-utf-8;q=0.3,text/plain;version=0.0.4;q=0.2,*/*;q=0.1')
+PROMETHEUS_3_PROTOBUF_FIRST = ('application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;'
+                               'encoding=delimited;q=0.5,application/openmetrics-text;version=1.0.0;'
+                               'escaping=allow-utf-8;q=0.4,application/openmetrics-text;version=0.0.1;q=0.3,'
+                               'text/plain;version=0.0.4;q=0.2,*/*;q=0.1')
+
+
+class NegotiateTest(unittest.TestCase):
+    def test_prometheus(self):
+        # accept header -> format without and with openmetrics enabled
+        cases = [
+            (PROMETHEUS_2, lib.TEXT, lib.OPENMETRICS),
+            (PROMETHEUS_2_NATIVE_HISTOGRAMS, lib.PROTOBUF, lib.PROTOBUF),
+            (PROMETHEUS_3, lib.TEXT, lib.OPENMETRICS),
+            (PROMETHEUS_3_PROTOBUF_FIRST, lib.PROTOBUF, lib.PROTOBUF),
+            ('text/plain;version=0.0.4', lib.TEXT, lib.TEXT),
+        ]
+        for accept, default, openmetrics in cases:
+            self.assertEqual(lib.negotiate(accept), default, accept)
+            self.assertEqual(lib.negotiate(accept, openmetrics=True), openmetrics, accept)
+
+    def test_fallback(self):
+        for accept in (None, '', '*/*', 'application/json', 'text/plain;q=0,application/json'):
+            self.assertEqual(lib.negotiate(accept, openmetrics=True), lib.TEXT, accept)
+
+    def test_protobuf_encoding(self):
+        proto = 'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily'
+        self.assertEqual(lib.negotiate(proto + ';encoding=delimited'), lib.PROTOBUF)
+        self.assertEqual(lib.negotiate(proto + '; encoding="delimited"'), lib.PROTOBUF)
+        for encoding in ('', ';encoding=text', ';encoding=compact-text'):
+            self.assertEqual(lib.negotiate(proto + encoding), lib.TEXT, encoding)
+        self.assertEqual(lib.negotiate('application/vnd.google.protobuf;encoding=delimited'), lib.TEXT)
+
+    def test_openmetrics_version(self):
+        self.assertEqual(lib.negotiate('application/openmetrics-text', openmetrics=True), lib.OPENMETRICS)
+        self.assertEqual(lib.negotiate('application/openmetrics-text;version=0.0.1', openmetrics=True), lib.TEXT)
+        self.assertEqual(lib.negotiate('application/openmetrics-text;version=0.0.1,application/openmetrics-text;'
+                                       'version=1.0.0;q=0.5', openmetrics=True), lib.OPENMETRICS)
+
+    def test_quality(self):
+        self.assertEqual(lib.negotiate('text/plain;q=0.5,application/openmetrics-text;q=0.9', openmetrics=True),
+                         lib.OPENMETRICS)
+        self.assertEqual(lib.negotiate('text/plain;q=0.9,application/openmetrics-text;q=0.5', openmetrics=True),
+                         lib.TEXT)
+        self.assertEqual(lib.negotiate('application/openmetrics-text,text/plain', openmetrics=True),
+                         lib.OPENMETRICS)
+
+
+class RateWindowTest(unittest.TestCase):
+    def test_collections_more_often_than_slots(self):
+        for window, interval in ((600, 15), (300, 15), (60, 3)):
+            results = collect(lib.RateWindow(window), interval, 60)
+            slot = float(window) / 16
+            for now, changes, elapsed in results:
+                if now - results[0][0] < slot:
+                    # Nothing older than the current slot yet
+                    self.assertIsNone(changes)
+                    continue
+                self.assertIsNotNone(changes, (window, interval, now))
+                self.assertGreater(elapsed, 0)
+                self.assertLessEqual(elapsed, window)
+                self.assertEqual(changes, [elapsed / interval])
+            # Once the window is filled changes cover most of it
+            self.assertGreaterEqual(results[-1][2], window - 2 * slot)
+
+    def test_collections_further_apart_than_window(self):
+        results = collect(lib.RateWindow(60), 100, 5)
+        self.assertIsNone(results[0][1])
+        for now, changes, elapsed in results[1:]:
+            self.assertEqual(elapsed, 100)
+            self.assertEqual(changes, [1])
+
+    def test_metric_missing_from_base_collection(self):
+        window = lib.RateWindow(60)
+        window.begin(1.0)
+        window.change('a', [1])
+        window.begin(100.0)
+        self.assertIsNone(window.change('b', [1]))
+        self.assertEqual(window.change('a', [3]), [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# vim: tabstop=4 expandtab shiftwidth=4
+
+import json
+import math
+import re
+import struct
+import unittest
+
+from benchmarks.fake_core import CURSORS, INFO, make_metrics
+from stellar_core_prometheus_exporter import exporter, lib, protobuf
+
+
+# Minimal decoder of the protobuf wire format, independent of the encoder
+
+def read_varint(data, idx):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[idx]
+        idx += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, idx
+
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode(data):
+    # Returns field number -> list of values, varints as ints, doubles as floats and length delimited as bytes
+    fields = {}
+    idx = 0
+    while idx < len(data):
+        key, idx = read_varint(data, idx)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, idx = read_varint(data, idx)
+        elif wire_type == 1:
+            value = struct.unpack_from('<d', data, idx)[0]
+            idx += 8
+        elif wire_type == 2:
+            length, idx = read_varint(data, idx)
+            value = data[idx:idx + length]
+            idx += length
+            if idx > len(data):
+                raise AssertionError('truncated field {}'.format(number))
+        else:
+            raise AssertionError('unexpected wire type {}'.format(wire_type))
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def decode_families(data):
+    # Returns the decoded fields of each length delimited MetricFamily message
+    families = []
+    idx = 0
+    while idx < len(data):
+        length, idx = read_varint(data, idx)
+        families.append(decode(data[idx:idx + length]))
+        idx += length
+    assert idx == len(data)
+    return families
+
+
+def labels(metric):
+    return tuple(sorted((decode(pair)[1][0].decode('utf-8'), decode(pair)[2][0].decode('utf-8'))
+                        for pair in metric.get(1, [])))
+
+
+# MetricType -> name
+TYPES = {0: 'counter', 1: 'gauge', 2: 'summary', 3: 'untyped', 4: 'histogram'}
+
+
+def protobuf_samples(data):
+    """Returns the samples of a protobuf exposition like text_samples and the type of each family."""
+    samples = set()
+    types = {}
+    for family in decode_families(data):
+        name = family[1][0].decode('utf-8')
+        prom_type = TYPES[family[3][0]]
+        types[name] = prom_type
+        for metric in map(decode, family.get(4, [])):
+            metric_labels = labels(metric)
+            if prom_type in ('counter', 'gauge', 'untyped'):
+                field = {'counter': 3, 'gauge': 2, 'untyped': 5}[prom_type]
+                samples.add((name, metric_labels, None, decode(metric[field][0])[1][0]))
+                continue
+            field = 4 if prom_type == 'summary' else 7
+            value = decode(metric[field][0])
+            samples.add((name + '_count', metric_labels, None, float(value.get(1, [0])[0])))
+            samples.add((name + '_sum', metric_labels, None, value.get(2, [0.0])[0]))
+            for point in map(decode, value.get(3, [])):
+                if prom_type == 'summary':
+                    samples.add((name, metric_labels, point[1][0], point[2][0]))
+                else:
+                    samples.add((name + '_bucket', metric_labels, point[2][0], float(point.get(1, [0])[0])))
+    return samples, types
+
+
+SAMPLE_LINE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="([^"]*)"')
+
+
+def text_samples(data):
+    """Returns the samples of a text exposition as (name, labels, quantile or le, value) and the type of each family."""
+    samples = set()
+    types = {}
+    for line in data.decode('utf-8').splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, prom_type = line.split(' ')
+            types[name] = prom_type
+            continue
+        if line.startswith('#'):
+            continue
+        name, label_text, value = SAMPLE_LINE.match(line).groups()
+        sample_labels = LABEL.findall(label_text or '')
+        bound = None
+        for pair in list(sample_labels):
+            if pair[0] in ('le', 'quantile'):
+                bound = float(pair[1])
+                sample_labels.remove(pair)
+        samples.add((name, tuple(sorted(sample_labels)), bound, float(value)))
+    return samples, types
+
+
+def collect(metrics=50):
+    collector = exporter.Collector('http://127.0.0.1:11626')
+    return collector.to_registry((200, json.dumps(make_metrics(metrics)).encode('utf-8')),
+                                 (200, json.dumps(INFO).encode('utf-8')),
+                                 (200, json.dumps(CURSORS).encode('utf-8')))
+
+
+class WireFormatTest(unittest.TestCase):
+    def test_varint(self):
+        self.assertEqual(protobuf.varint(0), b'\x00')
+        self.assertEqual(protobuf.varint(127), b'\x7f')
+        self.assertEqual(protobuf.varint(128), b'\x80\x01')
+        self.assertEqual(protobuf.varint(300), b'\xac\x02')
+        for value in (1, 129, 16383, 16384, 2**32, 2**63 - 1):
+            self.assertEqual(read_varint(protobuf.varint(value), 0), (value, len(protobuf.varint(value))))
+
+    def test_sint(self):
+        # zigzag encoding maps 0, -1, 1, -2, ... to 0, 1, 2, 3, ...
+        for value, encoded in ((0, 0), (-1, 1), (1, 2), (-2, 3), (-64, 127), (64, 128), (-2**31, 2**32 - 1)):
+            self.assertEqual(protobuf.sint_field(1, value), b'\x08' + protobuf.varint(encoded))
+            self.assertEqual(zigzag(encoded), value)
+
+    def test_fields(self):
+        self.assertEqual(protobuf.double_field(2, 1.5), b'\x11' + struct.pack('<d', 1.5))
+        self.assertEqual(protobuf.string_field(1, 'ab'), b'\x0a\x02ab')
+        self.assertEqual(decode(protobuf.string_field(1, 'x' * 200)), {1: [b'x' * 200]})
+
+
+class EncoderTest(unittest.TestCase):
+    def test_counter_gauge_untyped(self):
+        registry = lib.Registry(default_labels=(('instance', 'a'),))
+        registry.Counter('requests_total', 'Requests', 3)
+        registry.Gauge('temperature', 'Temperature', -1.5, labels=(('room', 'b'), ('floor', '1')))
+        registry.add('meter', 'Meter', 'untyped', registry.labels_text(None), 7)
+        families = decode_families(registry.render(lib.PROTOBUF))
+        self.assertEqual([f[1][0] for f in families], [b'requests_total', b'temperature', b'meter'])
+        self.assertEqual([f[2][0] for f in families], [b'Requests', b'Temperature', b'Meter'])
+        self.assertEqual([f[3][0] for f in families], [0, 1, 3])
+        counter = decode(families[0][4][0])
+        self.assertEqual(labels(counter), (('instance', 'a'),))
+        self.assertEqual(decode(counter[3][0]), {1: [3.0]})
+        gauge = decode(families[1][4][0])
+        self.assertEqual(labels(gauge), (('floor', '1'), ('room', 'b')))
+        self.assertEqual(decode(gauge[2][0]), {1: [-1.5]})
+        self.assertEqual(decode(decode(families[2][4][0])[5][0]), {1: [7.0]})
+
+    def test_summary_grouping(self):
+        registry = lib.Registry(default_labels=())
+        for node, scale in (('a', 1), ('b', 2)):
+            for quantile in ('0.75', '0.99'):
+                registry.Quantile('latency', 'Latency', float(quantile) * scale,
+                                  labels=(('node', node), ('quantile', quantile)))
+            registry.Summary('latency', 'Latency', 10 * scale, 2.5 * scale, labels=(('node', node),))
+        families = decode_families(registry.render(lib.PROTOBUF))
+        self.assertEqual(len(families), 1)
+        self.assertEqual(families[0][3], [2])
+        metrics = [decode(m) for m in families[0][4]]
+        self.assertEqual([labels(m) for m in metrics], [(('node', 'a'),), (('node', 'b'),)])
+        for metric, scale in zip(metrics, (1, 2)):
+            summary = decode(metric[4][0])
+            self.assertEqual(summary[1], [10 * scale])
+            self.assertEqual(summary[2], [2.5 * scale])
+            self.assertEqual([(decode(q)[1][0], decode(q)[2][0]) for q in summary[3]],
+                             [(0.75, 0.75 * scale), (0.99, 0.99 * scale)])
+
+    def test_histogram(self):
+        registry = lib.Registry(default_labels=())
+        for bound, count in ((1.0, 1), (0.5, 0), ('+Inf', 4)):
+            registry.Histogram('size', 'Size', bound, count)
+        registry.Summary('size', 'Size', 4, 9.5, prom_type='histogram')
+        family, = decode_families(registry.render(lib.PROTOBUF))
+        self.assertEqual(family[3], [4])
+        histogram = decode(decode(family[4][0])[7][0])
+        self.assertEqual(histogram[1], [4])
+        self.assertEqual(histogram[2], [9.5])
+        # Buckets are sorted by upper bound
+        self.assertEqual([(decode(b).get(1, [0])[0], decode(b)[2][0]) for b in histogram[3]],
+                         [(0, 0.5), (1, 1.0), (4, float('inf'))])
+        # No native histogram fields without a schema
+        self.assertFalse(set(histogram) & {5, 6, 7, 12, 13})
+
+
+def native_counts(histogram):
+    # Returns the zero bucket count and exponential bucket index -> count of a decoded Histogram
+    counts = {}
+    index = None
+    deltas = iter(zigzag(delta) for delta in histogram.get(13, []))
+    count = 0
+    for span in map(decode, histogram.get(12, [])):
+        offset = zigzag(span[1][0]) if 1 in span else 0
+        index = offset if index is None else index + offset
+        for _ in range(span.get(2, [0])[0]):
+            count += next(deltas)
+            counts[index] = count
+            index += 1
+    assert next(deltas, None) is None
+    return histogram.get(7, [0])[0], counts
+
+
+class NativeHistogramTest(unittest.TestCase):
+    def native(self, buckets, schema):
+        registry = lib.Registry(default_labels=())
+        for bound, count in buckets:
+            registry.Histogram('h', 'H', bound, count)
+        registry.Summary('h', 'H', buckets[-1][1], 0, prom_type='histogram')
+        family, = decode_families(registry.render(lib.PROTOBUF, schema))
+        histogram = decode(decode(family[4][0])[7][0])
+        self.assertEqual(zigzag(histogram[5][0]), schema)
+        self.assertEqual(histogram[6], [protobuf.ZERO_THRESHOLD])
+        return histogram
+
+    def test_spans_and_deltas(self):
+        histogram = self.native([(0.001, 1), (0.002, 3), (1, 3), ('+Inf', 4)], 0)
+        # Buckets -9 and -8, a gap up to 0 and the +Inf count in the bucket after it
+        self.assertEqual([(zigzag(decode(s)[1][0]), decode(s)[2][0]) for s in histogram[12]], [(-9, 2), (7, 2)])
+        self.assertEqual([zigzag(d) for d in histogram[13]], [1, 1, -2, 1])
+        self.assertEqual(native_counts(histogram), (0, {-9: 1, -8: 2, 0: 0, 1: 1}))
+
+    def test_bucket_bounds(self):
+        bounds = [1e-40, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 1.5, 5, 10, 1000, 86400]
+        buckets = [(bound, i + 1) for i, bound in enumerate(bounds)] + [('+Inf', len(bounds) + 5)]
+        for schema in range(-4, 9):
+            zero_count, counts = native_counts(self.native(buckets, schema))
+            # Values at or below the zero threshold are counted in the zero bucket
+            self.assertEqual(zero_count, 1)
+            self.assertEqual(sum(counts.values()), len(bounds) + 5 - 1)
+            base = 2.0 ** (2.0 ** -schema)
+            for bound in bounds[1:]:
+                # Bucket index holds (base ** (index - 1), base ** index]
+                index = int(math.ceil(math.log(bound, base) - 1e-9))
+                self.assertTrue(base ** (index - 1) < bound <= base ** index * (1 + 1e-9), (schema, bound))
+                self.assertGreaterEqual(counts.get(index, 0), 1, (schema, bound))
+            self.assertEqual(counts[max(counts)], 5)
+
+
+class ExpositionTest(unittest.TestCase):
+    def test_same_samples_as_text(self):
+        registry = collect()
+        text, text_types = text_samples(registry.render(lib.TEXT))
+        samples, types = protobuf_samples(registry.render(lib.PROTOBUF, 3))
+        self.assertEqual(samples, text)
+        self.assertEqual(types, text_types)
+
+    def test_openmetrics_types(self):
+        registry = collect()
+        _, text_types = text_samples(registry.render(lib.TEXT))
+        _, openmetrics_types = text_samples(registry.render(lib.OPENMETRICS))
+        for name, prom_type in text_types.items():
+            if prom_type == 'counter' and not name.endswith('_total'):
+                self.assertEqual(openmetrics_types[name], 'unknown')
+            elif prom_type == 'counter':
+                self.assertEqual(openmetrics_types[name[:-len('_total')]], 'counter')
+            else:
+                self.assertEqual(openmetrics_types[name], prom_type if prom_type != 'untyped' else 'unknown')
+
+
+if __name__ == "__main__":
+    unittest.main()